@@ -0,0 +1,122 @@
+"""
+Tests for the queued exchange writer in state.py, run against fake database helpers.
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("BOT_TOKEN", "test-token")
+os.environ.setdefault("YC_FOLDER_ID", "test-folder")
+os.environ.setdefault("YC_API_KEY", "test-key")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+
+from yandexgpt_bot import state
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class FakeSession:
+    def __init__(self, db):
+        self.db = db
+        self.staged = []
+
+    def commit(self):
+        self.db.rows += self.staged
+        self.staged = []
+
+    def rollback(self):
+        self.staged = []
+
+    def close(self):
+        pass
+
+
+class FakeDatabase:
+    """Stores written turns in rows; the session factory fails the first `failures` calls"""
+
+    def __init__(self, failures=0):
+        self.rows = []
+        self.failures = failures
+
+    def session(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionLost("could not connect to server")
+        return FakeSession(self)
+
+    def next_sequences(self, session, chat_ids):
+        return {chat_id: 0 for chat_id in chat_ids}
+
+    def bulk_add_histories(self, session, histories, commit=True):
+        for chat_id, _, turns in histories:
+            session.staged += [(chat_id, role, text) for role, text in turns]
+
+
+class ExchangeQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase(failures=1)
+        patches = {
+            "USE_DATABASE": True,
+            "db_initialized": True,
+            "Session": self.db.session,
+            "next_sequences": self.db.next_sequences,
+            "bulk_add_histories": self.db.bulk_add_histories,
+            "add_usage_record": mock.Mock(),
+            "is_disconnect_error": lambda exc: isinstance(exc, ConnectionLost),
+            "_EXCHANGE_RETRY_DELAY": 0,
+            "_exchanges_queued": asyncio.Event(),
+        }
+        for name, value in patches.items():
+            patcher = mock.patch.object(state, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        state._pending_exchanges.clear()
+        self.addCleanup(state._pending_exchanges.clear)
+
+    def test_failed_session_keeps_exchanges_queued(self):
+        state._record_exchange(1, "q1", "a1")
+        state._record_exchange(2, "q2", "a2")
+
+        with self.assertRaises(ConnectionLost):
+            state._write_pending_exchanges()
+        self.assertEqual(list(state._pending_exchanges), [1, 2])
+        self.assertEqual(self.db.rows, [])
+
+        # Recorded while the write was failing; must stay behind the requeued exchange
+        state._record_exchange(1, "q3", "a3")
+        state._write_pending_exchanges()
+        self.assertEqual(self.db.rows, [
+            (1, "user", "q1"), (1, "assistant", "a1"),
+            (1, "user", "q3"), (1, "assistant", "a3"),
+            (2, "user", "q2"), (2, "assistant", "a2"),
+        ])
+        self.assertFalse(state._pending_exchanges)
+        self.assertFalse(state._writing_chats)
+
+    def test_writer_survives_failed_batch(self):
+        async def run_writer():
+            writer = asyncio.create_task(state._write_exchanges_continuously())
+            state._record_exchange(1, "q1", "a1")
+            state._record_exchange(2, "q2", "a2")
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if len(self.db.rows) == 4:
+                    break
+            self.assertFalse(writer.done())
+            writer.cancel()
+
+        with self.assertLogs(level="ERROR"):
+            asyncio.run(run_writer())
+        self.assertEqual(self.db.rows, [
+            (1, "user", "q1"), (1, "assistant", "a1"),
+            (2, "user", "q2"), (2, "assistant", "a2"),
+        ])
+        self.assertFalse(state._pending_exchanges)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,23 +2,25 @@
 Administrative panel module for the YandexGPT bot. Provides bot management interface via Telegram.
 """
 import os
-import yaml
+import asyncio
+import aiofiles
+import aiofiles.os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler
 import datetime
 import logging
-from typing import List, Dict, Any, Optional
-import matplotlib.pyplot as plt
+from typing import List, Dict, Any, Optional, Tuple
 import io
-from sqlalchemy import func
+from sqlalchemy import case, func, literal
 
-from .config import ADMIN_CHAT_IDS, USE_DATABASE, LANGUAGE
-from .state import UNLIMITED_IDS, _save_state, db_initialized
+from .config import ADMIN_CHAT_IDS, USE_DATABASE, LANGUAGE, UNLIMITED_IDS_PATH
+from . import state
+from .state import db_initialized, _update_unlimited_ids
 from .translations import get_text, get_current_language
 
 # Import DB functions if database is enabled
 if USE_DATABASE and db_initialized:
-    from .db import Session, get_or_create_chat, set_unlimited_status, Chat, UsageRecord, ImageUsageRecord, Message
+    from .db import Session, set_unlimited_status, Chat, UsageRecord, ImageUsageRecord, Message
 
 # Callback data constants
 ADD_USER = 'add_user'
@@ -36,6 +38,9 @@ SELECT_REMOVE_USER = 'select_remove'
 admin_states = {}
 unlimited_users_cache = {}
 
+# Serializes rewrites of the unlimited IDs file between concurrent admin actions
+_unlimited_file_lock = asyncio.Lock()
+
 async def is_admin(update: Update) -> bool:
     """Check if the user is whitelisted as admin"""
     user_id = update.effective_user.id
@@ -78,7 +83,6 @@ async def admin_panel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handler for admin panel button clicks"""
     query = update.callback_query
-    chat_id = update.effective_chat.id
     lang = get_current_language()
     
     if not await is_admin(update):
@@ -89,59 +93,53 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
     
     data = query.data
     
-    if data == BACK:
-        admin_states.pop(chat_id, None)  # Reset state
-        await query.edit_message_text(
-            f"🛠 *{get_text('admin_panel_title', lang=lang)}*\n\n"
-            f"{get_text('admin_panel_welcome', lang=lang)}",
-            reply_markup=get_main_admin_keyboard(lang=lang),
-            parse_mode=constants.ParseMode.MARKDOWN
-        )
-    
-    elif data == LIST_USERS:
-        await show_unlimited_users(update, context)
-    
-    elif data == STATS:
-        await show_stats(update, context)
-    
-    elif data == ADD_USER:
-        admin_states[chat_id] = {'action': ADD_USER}
-        await query.edit_message_text(
-            f"*{get_text('add_user_title', lang=lang)}*\n\n"
-            f"{get_text('add_user_description', lang=lang)}\n\n"
-            f"{get_text('add_user_share_contact', lang=lang)}",
-            parse_mode=constants.ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back", lang=lang), callback_data=BACK)]])
-        )
-    
-    elif data == REMOVE_USER:
-        await show_users_for_removal(update, context)
-    
-    elif data == LANGUAGE_MENU:
-        await show_language_menu(update, context)
-    
-    elif data.startswith(SET_LANGUAGE):
-        language = data.split(':')[1]
-        await set_language(update, context, language)
-    
-    elif data.startswith(CONFIRM_ADD):
-        user_id = int(data.split(':')[1])
-        await add_unlimited_user(update, context, user_id)
-    
-    elif data.startswith(CONFIRM_REMOVE):
-        user_id = int(data.split(':')[1])
-        await remove_unlimited_user(update, context, user_id)
+    handler = _EXACT_HANDLERS.get(data)
+    if handler is not None:
+        await handler(update, context)
+        return
     
-    elif data.startswith(SELECT_REMOVE_USER):
-        user_id = int(data.split(':')[1])
-        await query.edit_message_text(
-            get_text("confirm_remove_user", user_id=user_id, lang=lang),
-            parse_mode=constants.ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(get_text("btn_yes", lang=lang), callback_data=f"{CONFIRM_REMOVE}:{user_id}")],
-                [InlineKeyboardButton(get_text("btn_no", lang=lang), callback_data=BACK)]
-            ])
-        )
+    prefix, _, arg = data.partition(':')
+    handler = _PREFIX_HANDLERS.get(prefix)
+    if handler is not None:
+        await handler(update, context, arg)
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Returns to the main admin panel page"""
+    query = update.callback_query
+    lang = get_current_language()
+    admin_states.pop(update.effective_chat.id, None)  # Reset state
+    await query.edit_message_text(
+        f"🛠 *{get_text('admin_panel_title', lang=lang)}*\n\n"
+        f"{get_text('admin_panel_welcome', lang=lang)}",
+        reply_markup=get_main_admin_keyboard(lang=lang),
+        parse_mode=constants.ParseMode.MARKDOWN
+    )
+
+async def show_add_user_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Asks the admin for the ID or contact of a user to add"""
+    query = update.callback_query
+    lang = get_current_language()
+    admin_states[update.effective_chat.id] = {'action': ADD_USER}
+    await query.edit_message_text(
+        f"*{get_text('add_user_title', lang=lang)}*\n\n"
+        f"{get_text('add_user_description', lang=lang)}\n\n"
+        f"{get_text('add_user_share_contact', lang=lang)}",
+        parse_mode=constants.ParseMode.MARKDOWN,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back", lang=lang), callback_data=BACK)]])
+    )
+
+async def show_remove_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    """Asks the admin to confirm removal of the selected user"""
+    query = update.callback_query
+    lang = get_current_language()
+    await query.edit_message_text(
+        get_text("confirm_remove_user", user_id=user_id, lang=lang),
+        parse_mode=constants.ParseMode.MARKDOWN,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(get_text("btn_yes", lang=lang), callback_data=f"{CONFIRM_REMOVE}:{user_id}")],
+            [InlineKeyboardButton(get_text("btn_no", lang=lang), callback_data=BACK)]
+        ])
+    )
 
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
@@ -213,7 +211,7 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
                 )
                 return True
             
-            user_id = unlimited_users[selection - 1]
+            user_id = unlimited_users[selection - 1][0]
             
             await update.message.reply_text(
                 get_text("confirm_remove_user", user_id=user_id, lang=get_current_language()),
@@ -239,21 +237,31 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
     return False
 
-def get_unlimited_users_list() -> List[int]:
-    """Gets the list of users with unlimited access"""
+def get_unlimited_users_list() -> List[Tuple[int, Optional[str]]]:
+    """
+    Gets the list of users with unlimited access as (chat_id, label) pairs.
+    The label is built from chat info cached in the database, or None if unknown.
+    """
     if USE_DATABASE and db_initialized:
         try:
-            from .db import Session, Chat
             session = Session()
-            chats = session.query(Chat).filter_by(is_unlimited=True).all()
-            unlimited_users = [chat.chat_id for chat in chats]
+            label = case(
+                (Chat.username.isnot(None), literal('@') + Chat.username),
+                else_=func.coalesce(Chat.first_name, Chat.title),
+            )
+            rows = (
+                session.query(Chat.chat_id, label)
+                .filter(Chat.is_unlimited.is_(True))
+                .order_by(Chat.chat_id)
+                .all()
+            )
             session.close()
-            return sorted(unlimited_users)
+            return [(chat_id, name) for chat_id, name in rows]
         except Exception as e:
             logging.error(f"Error getting unlimited users list: {e}")
-            return sorted(list(UNLIMITED_IDS))
+            return [(chat_id, None) for chat_id in sorted(state.UNLIMITED_IDS)]
     else:
-        return sorted(list(UNLIMITED_IDS))
+        return [(chat_id, None) for chat_id in sorted(state.UNLIMITED_IDS)]
 
 async def get_chat_username(bot, chat_id: int) -> str:
     """Gets the username of a user by chat_id"""
@@ -272,6 +280,12 @@ async def get_chat_username(bot, chat_id: int) -> str:
         logging.error(f"Error getting chat info for {chat_id}: {e}")
         return f"{chat_id}"
 
+async def resolve_usernames(bot, users: List[Tuple[int, Optional[str]]]) -> List[Tuple[int, str]]:
+    """Fills in missing labels from get_unlimited_users_list with concurrent Telegram lookups"""
+    missing = [user_id for user_id, username in users if username is None]
+    fetched = dict(zip(missing, await asyncio.gather(*(get_chat_username(bot, user_id) for user_id in missing))))
+    return [(user_id, username if username is not None else fetched[user_id]) for user_id, username in users]
+
 async def show_unlimited_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows the list of users with unlimited access with their usernames"""
     query = update.callback_query
@@ -294,8 +308,7 @@ async def show_unlimited_users(update: Update, context: ContextTypes.DEFAULT_TYP
     
     message = f"*{get_text('unlimited_users_title', lang=lang)}*\n\n"
     
-    for idx, user_id in enumerate(unlimited_users, 1):
-        username = await get_chat_username(context.bot, user_id)
+    for idx, (user_id, username) in enumerate(await resolve_usernames(context.bot, unlimited_users), 1):
         message += f"{idx}. {username} (`{user_id}`)\n"
     
     await query.edit_message_text(
@@ -322,16 +335,11 @@ async def show_users_for_removal(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
     
-    await query.edit_message_text(
-        f"*{get_text('remove_user_title', lang=lang)}*\n\n{get_text('remove_user_select', lang=lang)}\n\n"
-    )
-    
+    message = f"*{get_text('remove_user_title', lang=lang)}*\n\n{get_text('remove_user_select', lang=lang)}\n\n"
     keyboard = []
     
-    for idx, user_id in enumerate(unlimited_users, 1):
-        username = await get_chat_username(context.bot, user_id)
+    for idx, (user_id, username) in enumerate(await resolve_usernames(context.bot, unlimited_users), 1):
         message += f"{idx}. {username} (`{user_id}`)\n"
-        
         keyboard.append([InlineKeyboardButton(f"{idx}. {username}", callback_data=f"{SELECT_REMOVE_USER}:{user_id}")])
     
     keyboard.append([InlineKeyboardButton(get_text("btn_back", lang=lang), callback_data=BACK)])
@@ -342,6 +350,24 @@ async def show_users_for_removal(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+def render_activity_chart(labels, values, xlabel: str, title: str) -> io.BytesIO:
+    """Renders a horizontal bar chart of per-user activity to a PNG buffer"""
+    # matplotlib is heavy, so it is only loaded once someone opens the statistics
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(8, max(3, len(labels)*0.5)))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.barh(labels, values, color='skyblue')
+    ax.set_xlabel(xlabel)
+    ax.set_title(title)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    buf.seek(0)
+    return buf
+
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows bot usage statistics and activity charts"""
     query = update.callback_query
@@ -349,13 +375,19 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if USE_DATABASE and db_initialized:
         try:
             session = Session()
-            total_chats = session.query(Chat).count()
-            unlimited_chats = session.query(Chat).filter_by(is_unlimited=True).count()
+            total_chats = session.query(func.count(Chat.id)).scalar()
+            unlimited_chats = session.query(func.count(Chat.id)).filter(Chat.is_unlimited.is_(True)).scalar()
             today = datetime.datetime.utcnow().date()
             today_start = datetime.datetime.combine(today, datetime.time.min)
-            total_messages = session.query(Message).count()
-            today_requests = session.query(UsageRecord).filter(UsageRecord.date >= today_start).count()
-            today_images = session.query(ImageUsageRecord).filter(ImageUsageRecord.date >= today_start).count()
+            total_messages = session.query(func.count(Message.id)).scalar()
+            # Daily counter rows (date_bucket set) only back the rate limit; each request has its own row
+            today_requests = session.query(func.count(UsageRecord.id)).filter(
+                UsageRecord.date >= today_start, UsageRecord.date_bucket.is_(None)
+            ).scalar()
+            # Image usage is only kept as daily counters, so the images are the sum of the counts
+            today_images = session.query(func.coalesce(func.sum(ImageUsageRecord.count), 0)).filter(
+                ImageUsageRecord.date >= today_start
+            ).scalar()
             
             last_24h = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
             usage = session.query(UsageRecord).filter(UsageRecord.date >= last_24h).all()
@@ -375,15 +407,13 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             
             if sorted_stats:
                 labels, values = zip(*sorted_stats)
-                plt.figure(figsize=(8, max(3, len(labels)*0.5)))
-                plt.barh(labels, values, color='skyblue')
-                plt.xlabel(get_text("chart_requests_x", default="Requests in 24h", lang=lang))
-                plt.title(get_text("chart_requests_title", default="User activity over the last 24 hours", lang=lang))
-                plt.tight_layout()
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png')
-                buf.seek(0)
-                plt.close()
+                buf = await asyncio.to_thread(
+                    render_activity_chart,
+                    labels,
+                    values,
+                    get_text("chart_requests_x", default="Requests in 24h", lang=lang),
+                    get_text("chart_requests_title", default="User activity over the last 24 hours", lang=lang),
+                )
                 await query.message.reply_photo(photo=buf, caption=get_text("chart_requests_24h", lang=lang))
             
             message = (
@@ -401,7 +431,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     else:
         message = (
             f"*{get_text('stats_title', lang=lang)}*\n\n"
-            f"{get_text('stats_basic', count=len(UNLIMITED_IDS), lang=lang)}"
+            f"{get_text('stats_basic', count=len(state.UNLIMITED_IDS), lang=lang)}"
         )
     await query.edit_message_text(
         message,
@@ -454,18 +484,14 @@ async def add_unlimited_user(update: Update, context: ContextTypes.DEFAULT_TYPE,
         if USE_DATABASE and db_initialized:
             session = Session()
             try:
-                get_or_create_chat(session, user_id)
                 set_unlimited_status(session, user_id, True)
-                UNLIMITED_IDS.add(user_id)
+                _update_unlimited_ids(user_id, True)
             finally:
                 session.close()
         else:
-            UNLIMITED_IDS.add(user_id)
-            _save_state()
-        
-        from .config import UNLIMITED_IDS_PATH
-        with open(UNLIMITED_IDS_PATH, 'a') as f:
-            f.write(f"{user_id}\n")
+            # The whitelist file is only the source of truth without a database
+            _update_unlimited_ids(user_id, True)
+            await _write_unlimited_ids_file()
         
         admin_states.pop(update.effective_chat.id, None)
         await query.edit_message_text(
@@ -489,20 +515,13 @@ async def remove_unlimited_user(update: Update, context: ContextTypes.DEFAULT_TY
             session = Session()
             try:
                 set_unlimited_status(session, user_id, False)
-                UNLIMITED_IDS.discard(user_id)
+                _update_unlimited_ids(user_id, False)
             finally:
                 session.close()
         else:
-            UNLIMITED_IDS.discard(user_id)
-            _save_state()
-        
-        from .config import UNLIMITED_IDS_PATH
-        if UNLIMITED_IDS_PATH.exists():
-            with open(UNLIMITED_IDS_PATH, 'r') as f:
-                lines = [line.strip() for line in f if line.strip() and int(line.strip()) != user_id]
-            
-            with open(UNLIMITED_IDS_PATH, 'w') as f:
-                f.write('\n'.join(lines) + ('\n' if lines else ''))
+            # The whitelist file is only the source of truth without a database
+            _update_unlimited_ids(user_id, False)
+            await _write_unlimited_ids_file()
         
         admin_states.pop(update.effective_chat.id, None)
         await query.edit_message_text(
@@ -517,7 +536,34 @@ async def remove_unlimited_user(update: Update, context: ContextTypes.DEFAULT_TY
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back", lang=get_current_language()), callback_data=BACK)]])
         )
 
+async def _write_unlimited_ids_file() -> None:
+    """Rewrites the unlimited IDs file from the in-memory set"""
+    tmp_path = UNLIMITED_IDS_PATH.with_suffix(UNLIMITED_IDS_PATH.suffix + '.tmp')
+    async with _unlimited_file_lock:
+        async with aiofiles.open(tmp_path, 'w') as f:
+            await f.write(''.join(f"{chat_id}\n" for chat_id in sorted(state.UNLIMITED_IDS)))
+        await aiofiles.os.replace(tmp_path, UNLIMITED_IDS_PATH)
+
+# Callback data dispatch tables: exact matches first, then "<prefix>:<arg>" actions
+_EXACT_HANDLERS = {
+    BACK: show_main_menu,
+    LIST_USERS: show_unlimited_users,
+    STATS: show_stats,
+    ADD_USER: show_add_user_prompt,
+    REMOVE_USER: show_users_for_removal,
+    LANGUAGE_MENU: show_language_menu,
+}
+
+_PREFIX_HANDLERS = {
+    SET_LANGUAGE: set_language,
+    CONFIRM_ADD: lambda update, context, arg: add_unlimited_user(update, context, int(arg)),
+    CONFIRM_REMOVE: lambda update, context, arg: remove_unlimited_user(update, context, int(arg)),
+    SELECT_REMOVE_USER: lambda update, context, arg: show_remove_confirmation(update, context, int(arg)),
+}
+
 def register_admin_handlers(application):
     """Registers handlers for the admin panel"""
-    application.add_handler(CommandHandler("admin", admin_panel_cmd))
-    application.add_handler(CallbackQueryHandler(admin_callback_handler))
\ No newline at end of file
+    # Admin actions (stats charts, username lookups, file writes) can be slow,
+    # so run them as non-blocking tasks to keep other chats responsive
+    application.add_handler(CommandHandler("admin", admin_panel_cmd, block=False))
+    application.add_handler(CallbackQueryHandler(admin_callback_handler, block=False))
\ No newline at end of file
@@ -32,154 +32,18 @@ Run:  python yandex_gpt_bot.py
 """
 from __future__ import annotations
 
-import asyncio
-import datetime as _dt
 import logging
-import os
-from pathlib import Path
-from typing import Dict, List, Set, Tuple
-import io
 
-from telegram import Update, constants
-from telegram.ext import Application, CommandHandler, ContextTypes, Defaults, MessageHandler, filters
-from yandex_cloud_ml_sdk import YCloudML
-from .config import (
-    BOT_TOKEN, YC_FOLDER_ID, YC_API_KEY, DATA_DIR, UNLIMITED_IDS_PATH, STATE_FILE, YANDEXGPT_MODEL, MAX_HISTORY_TURNS, GPT_TEMPERATURE, MAX_QUESTION_LEN, DAILY_LIMIT, IMAGE_GENERATION_LIMIT, DEFAULT_SYSTEM_PROMPT
-)
+from telegram.ext import Application, CommandHandler, Defaults, MessageHandler, filters
+from .config import BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PORT
+from .state import start_background_tasks, stop_background_tasks
 from .handlers import start_cmd, ask_cmd, setprompt_cmd, reset_cmd, image_cmd, error_handler, message_handler
 
 # Import admin panel handlers
 from .admin_panel import register_admin_handlers
 
-# ----------------------------------------------------------------------------
-# Configuration
-# ----------------------------------------------------------------------------
-
-# ----------------------------------------------------------------------------
-# Runtime stores (in-memory)
-# ----------------------------------------------------------------------------
-ChatContext = List[Dict[str, str]]
-PROMPTS: Dict[int, str] = {}
-HISTORIES: Dict[int, ChatContext] = {}
-DAILY_USAGE: Dict[int, Tuple[_dt.date, int]] = {}
-DAILY_IMAGE_USAGE: Dict[int, Tuple[_dt.date, int]] = {}
-UNLIMITED_IDS: Set[int] = set()
-
-# ----------------------------------------------------------------------------
-# Load whitelist chat IDs
-# ----------------------------------------------------------------------------
-
-def _load_unlimited_ids() -> Set[int]:
-    # If file does not exist, return empty set
-    if not UNLIMITED_IDS_PATH.exists():
-        return set()
-    ids: Set[int] = set()
-    for line in UNLIMITED_IDS_PATH.read_text().splitlines():
-        line = line.strip()
-        # Try converting to int, handle potential errors and negative numbers
-        try:
-            ids.add(int(line))
-        except ValueError:
-            logging.warning(f"Skipping invalid line in unlimited_chats.txt: {line}")
-    return ids
-
-UNLIMITED_IDS = _load_unlimited_ids()
-
-# State persistence to JSON
-import json
-STATE_FILE = Path("state.json")
-
-def _load_state() -> None:
-    # Load persisted state if exists
-    if not STATE_FILE.exists():
-        return
-    data = json.loads(STATE_FILE.read_text())
-    for k, v in data.get("prompts", {}).items():
-        PROMPTS[int(k)] = v
-    for k, v in data.get("daily_usage", {}).items():
-        d = _dt.date.fromisoformat(v[0])
-        DAILY_USAGE[int(k)] = (d, v[1])
-    for k, v in data.get("image_usage", {}).items():
-        d = _dt.date.fromisoformat(v[0])
-        DAILY_IMAGE_USAGE[int(k)] = (d, v[1])
-
-
-def _save_state() -> None:
-    data = {
-        "prompts": {str(k): v for k, v in PROMPTS.items()},
-        "daily_usage": {str(k): [d.isoformat(), c] for k, (d, c) in DAILY_USAGE.items()},
-        "image_usage": {str(k): [d.isoformat(), c] for k, (d, c) in DAILY_IMAGE_USAGE.items()},
-        "histories": {str(k): v for k, v in HISTORIES.items()},
-    }
-    STATE_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2))
-
-# load persisted state
-_load_state()
-
-# ----------------------------------------------------------------------------
-# Yandex Cloud SDK client initialization
-# ----------------------------------------------------------------------------
-SDK = YCloudML(folder_id=YC_FOLDER_ID, auth=YC_API_KEY)
-
-# ----------------------------------------------------------------------------
-# Helper functions
-# ----------------------------------------------------------------------------
-
-def _ensure_context(chat_id: int) -> ChatContext:
-    if chat_id not in HISTORIES:
-        prompt = PROMPTS.get(chat_id, DEFAULT_SYSTEM_PROMPT)
-        HISTORIES[chat_id] = [{"role": "system", "text": prompt}]
-    return HISTORIES[chat_id]
-
-
-def _truncate_history(history: ChatContext) -> None:
-    extra = len(history) - (1 + 2 * MAX_HISTORY_TURNS)
-    if extra > 0:
-        del history[1:1 + extra]
-
-
-def _is_unlimited(chat_id: int) -> bool:
-    return chat_id in UNLIMITED_IDS
-
-
-def _check_and_increment_usage(chat_id: int) -> bool:
-    """Return True if under limit (and increment), False if limit exceeded."""
-    if _is_unlimited(chat_id):
-        return True
-    today = _dt.date.today()
-    last_date, count = DAILY_USAGE.get(chat_id, (today, 0))
-    if last_date != today:
-        count = 0  # reset daily counter
-    if count >= DAILY_LIMIT:
-        return False
-    DAILY_USAGE[chat_id] = (today, count + 1)
-    return True
-
-def _check_and_increment_image_usage(chat_id: int) -> bool:
-    """Return True if under image limit (and increment), False if limit exceeded."""
-    if _is_unlimited(chat_id):
-        return True
-    today = _dt.date.today()
-    last_date, count = DAILY_IMAGE_USAGE.get(chat_id, (today, 0))
-    if last_date != today:
-        count = 0
-    if count >= IMAGE_GENERATION_LIMIT:
-        return False
-    DAILY_IMAGE_USAGE[chat_id] = (today, count + 1)
-    return True
-
-async def _generate_reply(history: ChatContext) -> str:
-    loop = asyncio.get_event_loop()
-
-    def _call() -> str:
-        result = (
-            SDK.models.completions(YANDEXGPT_MODEL)
-            .configure(temperature=GPT_TEMPERATURE)
-            .run(history)
-        )
-        return result[0].text if result else "(empty response)"
-
-    return await loop.run_in_executor(None, _call)
+# Plain text messages that are not commands
+TEXT_NOT_COMMAND = filters.TEXT & ~filters.COMMAND
 
 # ----------------------------------------------------------------------------
 # Main entry point
@@ -191,6 +55,9 @@ def main() -> None:
         Application.builder()
         .token(BOT_TOKEN)
         .defaults(Defaults())
+        .concurrent_updates(True)
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
         .build()
     )
     app.add_handler(CommandHandler(["start", "help"], start_cmd))
@@ -203,14 +70,24 @@ def main() -> None:
     register_admin_handlers(app)
     
     # Handle regular text messages after commands
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    app.add_handler(MessageHandler(TEXT_NOT_COMMAND, message_handler))
     
     # Handle contact sharing events
     app.add_handler(MessageHandler(filters.CONTACT, message_handler))
     
     app.add_error_handler(error_handler)
     logging.info("Bot is starting...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us, so there is no polling round trip
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        )
+    else:
+        # Long polling: the request is held open until an update arrives
+        app.run_polling(poll_interval=0.0, timeout=30)
 
 
 if __name__ == "__main__":
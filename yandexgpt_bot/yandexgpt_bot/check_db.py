@@ -6,21 +6,24 @@ from pathlib import Path
 # Добавляем родительский каталог в путь Python
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from yandexgpt_bot.config import USE_DATABASE, DB_URL, UNLIMITED_IDS_PATH
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from yandexgpt_bot.db import Base, Chat
+from yandexgpt_bot import config
 
 def main():
     print("Checking database connection and data...")
     
-    if not USE_DATABASE:
+    if not config.USE_DATABASE:
         print("Database is disabled in config")
         return
     
+    # SQLAlchemy is only needed (and DB_URL only defined) when the database is enabled
+    from sqlalchemy import create_engine
+    from sqlalchemy.dialects.postgresql import insert
+    from sqlalchemy.orm import sessionmaker
+    from yandexgpt_bot.db import Chat
+    
     try:
         # Создаем подключение к базе данных напрямую
-        engine = create_engine(DB_URL)
+        engine = create_engine(config.DB_URL)
         Session = sessionmaker(bind=engine)
         session = Session()
         
@@ -29,20 +32,23 @@ def main():
         # Добавляем групповой чат из unlimited_chats.txt, если его нет в БД
         group_id = -1002206813481  # ID группового чата из unlimited_chats.txt
         
-        group_chat = session.query(Chat).filter_by(chat_id=group_id).first()
-        if not group_chat:
-            print(f"Adding group chat with ID {group_id} to database...")
-            group_chat = Chat(chat_id=group_id, is_unlimited=True)
-            session.add(group_chat)
-            session.commit()
-            print(f"Group chat added successfully")
+        # Один INSERT ... ON CONFLICT DO NOTHING вместо SELECT + INSERT
+        result = session.execute(
+            insert(Chat)
+            .values(chat_id=group_id, is_unlimited=True)
+            .on_conflict_do_nothing(index_elements=["chat_id"])
+        )
+        session.commit()
+        if result.rowcount:
+            print(f"Group chat with ID {group_id} added successfully")
         
         # Проверяем все записи в БД
-        chats = session.query(Chat).all()
+        # Читаем только нужные столбцы, без построения ORM-объектов
+        chats = session.query(Chat.id, Chat.chat_id, Chat.is_unlimited).all()
         print(f"Found {len(chats)} chats in database:")
         
-        for chat in chats:
-            print(f"ID: {chat.id}, Chat ID: {chat.chat_id}, Unlimited: {chat.is_unlimited}")
+        for id_, chat_id, is_unlimited in chats:
+            print(f"ID: {id_}, Chat ID: {chat_id}, Unlimited: {is_unlimited}")
     except Exception as e:
         print(f"Error accessing database: {e}")
     finally:
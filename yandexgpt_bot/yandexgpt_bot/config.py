@@ -23,20 +23,28 @@ data_dir = os.environ.get("DATA_DIR", ".")
 DATA_DIR = data_dir
 UNLIMITED_IDS_PATH = Path(data_dir) / os.environ.get("UNLIMITED_CHAT_IDS_FILE", "unlimited_chats.txt")
 STATE_FILE = Path(data_dir) / os.environ.get("STATE_FILE", "state.json")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 5))
+UNLIMITED_REFRESH_INTERVAL = float(os.environ.get("UNLIMITED_REFRESH_INTERVAL", 300))
 YANDEXGPT_MODEL = os.environ.get("YANDEXGPT_MODEL", "yandexgpt")
 MAX_HISTORY_TURNS = int(os.environ.get("MAX_HISTORY_TURNS", 10))
+MAX_CACHED_CHATS = int(os.environ.get("MAX_CACHED_CHATS", 10000))
 GPT_TEMPERATURE = float(os.environ.get("GPT_TEMPERATURE", 0.7))
+SDK_MAX_WORKERS = int(os.environ.get("SDK_MAX_WORKERS", 16))
 MAX_QUESTION_LEN = int(os.environ.get("MAX_QUESTION_LEN", 4000))
 DAILY_LIMIT = int(os.environ.get("DAILY_LIMIT", 15))
 IMAGE_GENERATION_LIMIT = int(os.environ.get("IMAGE_GENERATION_LIMIT", 5))
 DEFAULT_SYSTEM_PROMPT = os.environ.get("SYSTEM_PROMPT", "You are a helpful assistant.")
 
+# Webhook mode is used when a public base URL is set; otherwise the bot polls
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+
 # Interface language setting ("english" or "russian")
 LANGUAGE = os.environ.get("LANGUAGE", "english")
 
 # List of Telegram user IDs with admin privileges (comma-separated)
 admin_ids = os.environ.get("ADMIN_CHAT_IDS", "")
-ADMIN_CHAT_IDS = set(int(x) for x in admin_ids.split(",") if x.strip().isdigit())
+ADMIN_CHAT_IDS = frozenset(int(x) for x in admin_ids.split(",") if x.strip().isdigit())
 
 # Database configuration
 USE_DATABASE = os.environ.get("USE_DATABASE", "false").lower() == "true"
@@ -48,4 +56,12 @@ if USE_DATABASE:
     DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
     DB_NAME = os.environ.get("DB_NAME", "yagptbot")
     DB_ENCRYPTION_KEY = os.environ.get("DB_ENCRYPTION_KEY", "your-secure-encryption-key-change-me")
-    DB_URL = f"{DB_TYPE}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
\ No newline at end of file
+    # Changing this derives a different key, so existing encrypted data becomes unreadable
+    DB_KDF_ITERATIONS = int(os.environ.get("DB_KDF_ITERATIONS", 100000))
+    # "pbkdf2" or "scrypt"; the same caveat applies, so only new deployments should switch
+    DB_KDF = os.environ.get("DB_KDF", "pbkdf2").lower()
+    DB_URL = f"{DB_TYPE}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    # Connection pool tuning
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
\ No newline at end of file
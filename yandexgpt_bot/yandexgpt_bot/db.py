@@ -2,41 +2,167 @@
 Database module for YandexGPT bot using SQLAlchemy.
 This module handles database connections, models, and operations for the bot.
 """
+import csv
 import datetime
+import io
 import json
-from typing import Dict, List, Optional, Any
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Text, DateTime, Boolean, ForeignKey, func, LargeBinary
+from typing import Dict, List, Optional, Any, Tuple
+from sqlalchemy import bindparam, create_engine, make_url, delete, insert, select, text, Column, Integer, BigInteger, String, Date, DateTime, Boolean, ForeignKey, Index, UniqueConstraint, func, or_, LargeBinary
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session
-from sqlalchemy.dialects.postgresql import JSONB
-from cryptography.fernet import Fernet
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 import base64
+import functools
+import hashlib
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # Use absolute import
 from yandexgpt_bot import config
 
 Base = declarative_base()
 
+_KDF_SALT = b'yandexgpt_bot_salt'  # Use a proper salt in production!
+# Derived keys are cached here so restarts skip the deliberately slow KDF
+_KEY_CACHE_DIR = Path.home() / ".cache" / "yandexgpt_bot"
+
+def _derive_key(key_string: str, iterations: int, kdf_name: str = "pbkdf2") -> bytes:
+    """Runs the KDF for the key string, reusing the on-disk cache when it matches"""
+    if kdf_name == "scrypt":
+        cache_file = _KEY_CACHE_DIR / "scrypt.key"
+    elif kdf_name == "pbkdf2":
+        cache_file = _KEY_CACHE_DIR / f"fernet-{iterations}.key"
+    else:
+        raise ValueError(f"Unknown key derivation function: {kdf_name}")
+    # The cache holds the raw key followed by a check value tying it to key_string,
+    # so a changed DB_ENCRYPTION_KEY is never answered with a stale key
+    try:
+        cached = cache_file.read_bytes()
+        raw, check = cached[:32], cached[32:]
+        if len(raw) == 32 and check == hashlib.sha256(raw + key_string.encode()).digest():
+            return raw
+    except OSError:
+        pass
+    
+    if kdf_name == "scrypt":
+        # Memory-hard, so GPU guessing costs far more than with PBKDF2;
+        # iterations only apply to PBKDF2
+        kdf = Scrypt(salt=_KDF_SALT, length=32, n=2**14, r=8, p=1)
+    else:
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=_KDF_SALT,
+            iterations=iterations,
+        )
+    raw = kdf.derive(key_string.encode())
+    
+    # Caching is best effort: a read-only home directory only costs the KDF again
+    try:
+        _KEY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(".tmp")
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw + hashlib.sha256(raw + key_string.encode()).digest())
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return raw
+
 # Create encryption handler
-def get_encryption_key(key_string):
-    # Convert string key to bytes using PBKDF2
-    salt = b'yandexgpt_bot_salt'  # Use a proper salt in production!
-    kdf = PBKDF2HMAC(
+@functools.lru_cache(maxsize=4)
+def get_encryption_key(key_string, iterations=100000, kdf_name="pbkdf2"):
+    # Convert string key to bytes using the configured KDF
+    key = base64.urlsafe_b64encode(_derive_key(key_string, iterations, kdf_name))
+    return Fernet(key)
+
+@functools.lru_cache(maxsize=4)
+def get_aead_key(key_string, iterations=100000, kdf_name="pbkdf2"):
+    """Returns the AES-256-GCM cipher, keyed separately from Fernet via HKDF"""
+    key = HKDF(
         algorithm=hashes.SHA256(),
         length=32,
-        salt=salt,
-        iterations=100000,
-    )
-    key = base64.urlsafe_b64encode(kdf.derive(key_string.encode()))
-    return Fernet(key)
+        salt=None,
+        info=b'yandexgpt_bot aes-256-gcm',
+    ).derive(_derive_key(key_string, iterations, kdf_name))
+    return AESGCM(key)
+
+# New values are sealed with AES-256-GCM (a single AES-NI pass that also
+# authenticates) as version byte + 12-byte nonce + ciphertext. Fernet tokens
+# always start with "g" (base64 of their 0x80 version), so rows written before
+# the switch are told apart and still decrypt with Fernet
+_AES_GCM_VERSION = b'\x01'
+_NONCE_SIZE = 12
+
+def _encrypt(plaintext: bytes) -> bytes:
+    nonce = os.urandom(_NONCE_SIZE)
+    return _AES_GCM_VERSION + nonce + aead.encrypt(nonce, plaintext, None)
+
+def _decrypt(token: bytes) -> bytes:
+    if token[:1] == _AES_GCM_VERSION:
+        return aead.decrypt(token[1:1 + _NONCE_SIZE], token[1 + _NONCE_SIZE:], None)
+    return fernet.decrypt(token)
+
+# OpenSSL releases the GIL while decrypting, so large batches are split across threads
+_DECRYPT_WORKERS = os.cpu_count() or 1
+_DECRYPT_POOL = ThreadPoolExecutor(max_workers=_DECRYPT_WORKERS, thread_name_prefix="db-decrypt")
+# Below this many tokens the thread hand-off costs more than it saves
+_PARALLEL_DECRYPT_MIN = 64
+
+def _run_batched(func, tokens: List[bytes]) -> list:
+    """Applies a per-token crypto function, splitting large batches across threads, preserving order"""
+    if len(tokens) < _PARALLEL_DECRYPT_MIN:
+        return [func(token) for token in tokens]
+    size = -(-len(tokens) // _DECRYPT_WORKERS)
+    chunks = [tokens[i:i + size] for i in range(0, len(tokens), size)]
+    results = _DECRYPT_POOL.map(lambda chunk: [func(token) for token in chunk], chunks)
+    return [result for chunk in results for result in chunk]
+
+def _decrypt_many(tokens: List[bytes]) -> List[bytes]:
+    """Decrypts tokens, preserving order"""
+    return _run_batched(_decrypt, tokens)
+
+def _is_authentic(token: bytes) -> bool:
+    # Both ciphers authenticate the ciphertext, so a successful decrypt proves integrity
+    try:
+        _decrypt(token)
+    except (InvalidToken, InvalidTag):
+        return False
+    return True
+
+# Decrypted system prompts by chat_id, as (expiry, prompt). Prompts rarely
+# change, and set_system_prompt writes through, so reads skip the SELECT and
+# the Fernet decrypt. The TTL bounds staleness when another process edits them
+_PROMPT_CACHE_TTL = 300
+_PROMPT_CACHE_MAX = 10000
+_prompt_cache: Dict[int, Tuple[float, Optional[str]]] = {}
+# Handlers reach the database from worker threads
+_prompt_cache_lock = threading.Lock()
+
+def _cache_prompt(chat_id: int, prompt: Optional[str]) -> None:
+    with _prompt_cache_lock:
+        _prompt_cache.pop(chat_id, None)
+        if len(_prompt_cache) >= _PROMPT_CACHE_MAX:
+            # Dicts keep insertion order, so this drops the oldest entry
+            del _prompt_cache[next(iter(_prompt_cache))]
+        _prompt_cache[chat_id] = (time.monotonic() + _PROMPT_CACHE_TTL, prompt)
 
 # Global variables
 engine = None
 Session = None
-fernet = None  # Moved to init_db
+fernet = None  # Moved to init_db; only decrypts rows written before AES-GCM
+aead = None
 
 
 class Chat(Base):
@@ -58,19 +184,6 @@ class Chat(Base):
     image_usage_records = relationship("ImageUsageRecord", back_populates="chat", cascade="all, delete-orphan")
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
 
-    def update_user_info(self, username=None, first_name=None, title=None):
-        changed = False
-        if username is not None and username != self.username:
-            self.username = username
-            changed = True
-        if first_name is not None and first_name != self.first_name:
-            self.first_name = first_name
-            changed = True
-        if title is not None and title != self.title:
-            self.title = title
-            changed = True
-        return changed
-
 
 class SystemPrompt(Base):
     """System prompt for each chat"""
@@ -78,7 +191,7 @@ class SystemPrompt(Base):
     
     id = Column(Integer, primary_key=True)
     chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'), unique=True)
-    prompt_text = Column(Text, nullable=False)
+    prompt_text = Column(LargeBinary, nullable=False)  # Fernet token bytes, or UTF-8 text when unencrypted
     encrypted = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
@@ -88,16 +201,17 @@ class SystemPrompt(Base):
     
     def set_prompt(self, prompt: str) -> None:
         """Encrypt and set the prompt text"""
-        if config.USE_DATABASE and self.encrypted and fernet is not None:
-            self.prompt_text = fernet.encrypt(prompt.encode()).decode()
+        # An empty prompt reveals nothing, so it is stored as is
+        if config.USE_DATABASE and self.encrypted and prompt and fernet is not None:
+            self.prompt_text = _encrypt(prompt.encode())
         else:
-            self.prompt_text = prompt
+            self.prompt_text = prompt.encode()
     
     def get_prompt(self) -> str:
         """Decrypt and return the prompt text"""
         if config.USE_DATABASE and self.encrypted and self.prompt_text and fernet is not None:
-            return fernet.decrypt(self.prompt_text.encode()).decode()
-        return self.prompt_text
+            return _decrypt(self.prompt_text).decode()
+        return self.prompt_text.decode()
 
 
 class Message(Base):
@@ -105,44 +219,38 @@ class Message(Base):
     __tablename__ = 'messages'
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'), index=True)
+    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'))
     role = Column(String(50), nullable=False)  # 'system', 'user', 'assistant'
-    content = Column(Text, nullable=False)
+    content = Column(LargeBinary, nullable=False)  # Fernet token bytes, or UTF-8 text when unencrypted
     encrypted = Column(Boolean, default=True)
-    message_hash = Column(String(128), nullable=True)  # Optional hash for verification
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     sequence = Column(Integer, default=0)  # To maintain order
     
+    # History reads and the next-sequence lookup filter by chat and order by sequence
+    __table_args__ = (Index('ix_messages_chat_seq', 'chat_id', 'sequence'),)
+    
     # Relationship
     chat = relationship("Chat", back_populates="messages")
     
     def set_content(self, content: str) -> None:
         """Encrypt and set the message content"""
         if config.USE_DATABASE and self.encrypted and fernet is not None:
-            self.content = fernet.encrypt(content.encode()).decode()
-            # Create a hash for verification
-            digest = hashes.Hash(hashes.SHA256())
-            digest.update(content.encode())
-            self.message_hash = base64.b64encode(digest.finalize()).decode()
+            self.content = _encrypt(content.encode())
         else:
-            self.content = content
+            self.content = content.encode()
     
     def get_content(self) -> str:
         """Decrypt and return the message content"""
         if config.USE_DATABASE and self.encrypted and self.content and fernet is not None:
-            return fernet.decrypt(self.content.encode()).decode()
-        return self.content
+            return _decrypt(self.content).decode()
+        return self.content.decode()
     
     def verify_content(self) -> bool:
         """Verify the message content has not been tampered with"""
-        if not config.USE_DATABASE or not self.encrypted or not self.message_hash or fernet is None:
+        if not config.USE_DATABASE or not self.encrypted or fernet is None:
             return True
         
-        decrypted = self.get_content()
-        digest = hashes.Hash(hashes.SHA256())
-        digest.update(decrypted.encode())
-        current_hash = base64.b64encode(digest.finalize()).decode()
-        return current_hash == self.message_hash
+        return _is_authentic(self.content)
 
 
 class UsageRecord(Base):
@@ -150,13 +258,20 @@ class UsageRecord(Base):
     __tablename__ = 'usage_records'
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'), index=True)
+    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'))
     user_id = Column(BigInteger, nullable=True)  # ID of the user who sent the message
     user_username = Column(String(128), nullable=True)  # username of the user who sent the message
     user_first_name = Column(String(128), nullable=True)  # first name of the user who sent the message
-    date = Column(DateTime, default=datetime.datetime.utcnow)
+    date = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    date_bucket = Column(Date, nullable=True)  # day of the daily counter row; NULL on per-request rows
     count = Column(Integer, default=0)
     
+    # One daily counter per chat, so the limiter can UPSERT it
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'date_bucket', name='uq_usage_records_chat_day'),
+        Index('ix_usage_records_chat_date', 'chat_id', 'date'),
+    )
+    
     # Relationship
     chat = relationship("Chat", back_populates="usage_records")
 
@@ -166,37 +281,122 @@ class ImageUsageRecord(Base):
     __tablename__ = 'image_usage_records'
     
     id = Column(Integer, primary_key=True)
-    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'), index=True)
-    date = Column(DateTime, default=datetime.datetime.utcnow)
+    chat_id = Column(BigInteger, ForeignKey('chats.chat_id', ondelete='CASCADE'))
+    date = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    date_bucket = Column(Date, nullable=True)  # day of the daily counter row
     count = Column(Integer, default=0)
     
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'date_bucket', name='uq_image_usage_records_chat_day'),
+        Index('ix_image_usage_records_chat_date', 'chat_id', 'date'),
+    )
+    
     # Relationship
     chat = relationship("Chat", back_populates="image_usage_records")
 
 
+def _column_type(conn, table: str, column: str) -> Optional[str]:
+    return conn.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = :column"
+    ), {"table": table, "column": column}).scalar()
+
+
+def _create_index_concurrently(conn, name: str, table: str, columns: str, unique: bool = False) -> None:
+    """Builds an index without blocking writes, rebuilding one left INVALID by an interrupted build"""
+    valid = conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {"name": name}).scalar()
+    if valid:
+        return
+    if valid is not None:
+        # IF NOT EXISTS would skip an invalid index forever, and ON CONFLICT cannot use it
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+    conn.execute(text(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {table} ({columns})"))
+
+
+# Run once after an update via init_db.py --upgrade, not on every start: DDL takes
+# locks that would queue behind and block live traffic
+def upgrade_schema(engine) -> None:
+    """Adds columns and indexes that create_all does not add to existing tables"""
+    if engine.dialect.name != "postgresql":
+        return
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in (UsageRecord.__tablename__, ImageUsageRecord.__tablename__):
+            if _column_type(conn, table, "date_bucket") is None:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN date_bucket DATE"))
+            _create_index_concurrently(conn, f"uq_{table}_chat_day", table, "chat_id, date_bucket", unique=True)
+            _create_index_concurrently(conn, f"ix_{table}_chat_date", table, "chat_id, date")
+            _create_index_concurrently(conn, f"ix_{table}_date", table, "date")
+        _create_index_concurrently(conn, "ix_messages_chat_seq", Message.__tablename__, "chat_id, sequence")
+        # The composite indexes lead with chat_id, so the old single-column ones
+        # only cost extra work on every insert
+        for table in (Message.__tablename__, UsageRecord.__tablename__, ImageUsageRecord.__tablename__):
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_chat_id"))
+        # Encrypted columns moved from text to bytea; Fernet tokens are ASCII, so
+        # converting the stored text to UTF-8 bytes keeps every row readable
+        for table, column in ((Message.__tablename__, "content"), (SystemPrompt.__tablename__, "prompt_text")):
+            if _column_type(conn, table, column) == "text":
+                conn.execute(text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE bytea USING convert_to({column}, 'UTF8')"
+                ))
+
+
 def init_db():
     """Initialize database connection and create tables"""
-    global engine, Session, fernet
+    global engine, Session, fernet, aead
     
     if not config.USE_DATABASE:
         return False
     
     try:
-        engine = create_engine(config.DB_URL)
-        Session = sessionmaker(bind=engine)
+        engine_options = {}
+        if make_url(config.DB_URL).get_dialect().driver == "psycopg2":
+            # INSERTs are already batched into multi-VALUES statements; this also
+            # sends executemany UPDATEs and DELETEs in pages instead of row by row
+            engine_options["executemany_mode"] = "values_plus_batch"
+        # Handlers open a short-lived session per update, so connections are
+        # pooled and checked with a cheap ping before reuse
+        engine = create_engine(
+            config.DB_URL,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            **engine_options,
+        )
+        # Objects stay usable after commit without a reload SELECT
+        Session = sessionmaker(bind=engine, expire_on_commit=False)
+        # Only creates missing tables; existing ones are upgraded by init_db.py --upgrade
         Base.metadata.create_all(engine)
-        fernet = get_encryption_key(config.DB_ENCRYPTION_KEY)
+        fernet = get_encryption_key(config.DB_ENCRYPTION_KEY, config.DB_KDF_ITERATIONS, config.DB_KDF)
+        aead = get_aead_key(config.DB_ENCRYPTION_KEY, config.DB_KDF_ITERATIONS, config.DB_KDF)
         return True
     except Exception as e:
         print(f"Database initialization error: {e}")
         return False
 
 
+# Hot-path statements are built once; SQLAlchemy keys its compiled cache on the
+# statement structure, so reusing these skips rebuilding and re-hashing per call
+_SELECT_CHAT = select(Chat).where(Chat.chat_id == bindparam("chat_id"))
+_SELECT_PROMPT = select(SystemPrompt).where(SystemPrompt.chat_id == bindparam("chat_id"))
+_NEXT_SEQUENCE = (
+    select(func.coalesce(func.max(Message.sequence), -1) + 1)
+    .where(Message.chat_id == bindparam("chat_id"))
+)
+
+
 # Database utility functions
 
+def is_disconnect_error(exc: Exception) -> bool:
+    """True when the error comes from the database being unreachable rather than from the statement"""
+    return isinstance(exc, (OperationalError, InterfaceError)) or getattr(exc, "connection_invalidated", False)
+
+
 def get_or_create_chat(session: Session, chat_id: int) -> Chat:
     """Get or create a chat record"""
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
+    chat = session.execute(_SELECT_CHAT, {"chat_id": chat_id}).scalar_one_or_none()
     if not chat:
         chat = Chat(chat_id=chat_id)
         session.add(chat)
@@ -204,79 +404,234 @@ def get_or_create_chat(session: Session, chat_id: int) -> Chat:
     return chat
 
 
+def _ensure_chat(session: Session, chat_id: int) -> None:
+    """Creates the chat row if missing, without loading it or committing"""
+    session.execute(pg_insert(Chat).values(chat_id=chat_id).on_conflict_do_nothing(index_elements=[Chat.chat_id]))
+
+
+def _ensure_chats(session: Session, chat_ids: List[int]) -> None:
+    """Creates the missing chat rows with one multi-row INSERT, without committing"""
+    session.execute(
+        pg_insert(Chat)
+        .values([{"chat_id": chat_id} for chat_id in chat_ids])
+        .on_conflict_do_nothing(index_elements=[Chat.chat_id])
+    )
+
+
 def set_system_prompt(session: Session, chat_id: int, prompt: str) -> SystemPrompt:
     """Set system prompt for a chat"""
     chat = get_or_create_chat(session, chat_id)
     
-    system_prompt = session.query(SystemPrompt).filter_by(chat_id=chat_id).first()
+    system_prompt = session.execute(_SELECT_PROMPT, {"chat_id": chat_id}).scalar_one_or_none()
     if not system_prompt:
         system_prompt = SystemPrompt(chat_id=chat_id)
         session.add(system_prompt)
     
     system_prompt.set_prompt(prompt)
     session.commit()
+    _cache_prompt(chat_id, prompt)
     return system_prompt
 
 
+def set_system_prompts_bulk(session: Session, prompts: Dict[int, str], commit: bool = True) -> None:
+    """Set the system prompts of many chats with a single UPSERT, creating missing chats"""
+    if not prompts:
+        return
+    _ensure_chats(session, list(prompts))
+    encrypted = config.USE_DATABASE and fernet is not None
+    now = datetime.datetime.utcnow()
+    stmt = pg_insert(SystemPrompt).values([
+        {
+            "chat_id": chat_id,
+            # Same rule as SystemPrompt.set_prompt: empty prompts are stored as is
+            "prompt_text": _encrypt(prompt.encode()) if encrypted and prompt else prompt.encode(),
+            "encrypted": True,
+            "updated_at": now,
+        }
+        for chat_id, prompt in prompts.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SystemPrompt.chat_id],
+        set_={"prompt_text": stmt.excluded.prompt_text, "updated_at": now},
+    )
+    session.execute(stmt)
+    if commit:
+        session.commit()
+    for chat_id, prompt in prompts.items():
+        _cache_prompt(chat_id, prompt)
+
+
 def get_system_prompt(session: Session, chat_id: int) -> Optional[str]:
     """Get system prompt for a chat"""
-    system_prompt = session.query(SystemPrompt).filter_by(chat_id=chat_id).first()
-    if system_prompt:
-        return system_prompt.get_prompt()
-    return None
+    now = time.monotonic()
+    with _prompt_cache_lock:
+        cached = _prompt_cache.get(chat_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
+    system_prompt = session.execute(_SELECT_PROMPT, {"chat_id": chat_id}).scalar_one_or_none()
+    prompt = system_prompt.get_prompt() if system_prompt else None
+    _cache_prompt(chat_id, prompt)
+    return prompt
 
 
-def add_message(session: Session, chat_id: int, role: str, content: str, sequence: int = None) -> Message:
-    """Add a message to chat history"""
+def add_message(session: Session, chat_id: int, role: str, content: str, sequence: int = None, commit: bool = True) -> Message:
+    """Add a message to chat history; with commit=False it is only flushed into the open transaction"""
     chat = get_or_create_chat(session, chat_id)
     
     if sequence is None:
-        # Get the next sequence number
-        last_message = session.query(Message).filter_by(chat_id=chat_id).order_by(Message.sequence.desc()).first()
-        sequence = (last_message.sequence + 1) if last_message else 0
+        # Next sequence number, computed inside the INSERT instead of a separate SELECT
+        sequence = (
+            select(func.coalesce(func.max(Message.sequence), -1) + 1)
+            .where(Message.chat_id == chat_id)
+            .scalar_subquery()
+        )
     
     message = Message(chat_id=chat_id, role=role, sequence=sequence)
     message.set_content(content)
     
     session.add(message)
-    session.commit()
+    if commit:
+        session.commit()
+    else:
+        # Flush so a following add_message sees this row when picking its sequence
+        session.flush()
     return message
 
 
+def bulk_add_messages(session: Session, chat_id: int, messages: List[Tuple[str, str]], start_sequence: int = None, commit: bool = True) -> None:
+    """Add many (role, content) messages to chat history with a single COPY (one INSERT on drivers without COPY)"""
+    if not messages:
+        return
+    if start_sequence is None:
+        start_sequence = session.execute(_NEXT_SEQUENCE, {"chat_id": chat_id}).scalar()
+    bulk_add_histories(session, [(chat_id, start_sequence, messages)], commit=commit)
+
+
+def next_sequences(session: Session, chat_ids: List[int]) -> Dict[int, int]:
+    """Next free history sequence number of each chat, found with one query"""
+    last = dict(session.execute(
+        select(Message.chat_id, func.coalesce(func.max(Message.sequence), -1))
+        .where(Message.chat_id.in_(chat_ids))
+        .group_by(Message.chat_id)
+    ).all())
+    # Chats without messages start at 0
+    return {chat_id: last.get(chat_id, -1) + 1 for chat_id in chat_ids}
+
+
+_MESSAGE_COLUMNS = ("chat_id", "role", "content", "encrypted", "timestamp", "sequence")
+
+def bulk_add_histories(session: Session, histories: List[Tuple[int, int, List[Tuple[str, str]]]], commit: bool = True) -> None:
+    """Add the (chat_id, start_sequence, messages) histories of many chats with a single COPY (one INSERT on drivers without COPY)"""
+    histories = [history for history in histories if history[2]]
+    if not histories:
+        return
+    # Keeps the caller's transaction open, so commit=False batches stay atomic
+    _ensure_chats(session, [chat_id for chat_id, _, _ in histories])
+    
+    plaintexts = [content.encode() for _, _, messages in histories for _, content in messages]
+    encrypted = config.USE_DATABASE and fernet is not None
+    # Large batches are encrypted across the crypto thread pool
+    contents = iter(_run_batched(_encrypt, plaintexts) if encrypted else plaintexts)
+    timestamp = datetime.datetime.utcnow()
+    # Positional tuples built lazily: no per-row dict and no intermediate list on the COPY path
+    rows = (
+        (chat_id, role, next(contents), encrypted, timestamp, start_sequence + i)
+        for chat_id, start_sequence, messages in histories
+        for i, (role, _) in enumerate(messages)
+    )
+    
+    # The bot targets PostgreSQL; the branch below is about the driver
+    connection = session.connection()
+    if connection.dialect.driver == "psycopg2":
+        # COPY streams all rows in one command, far cheaper than per-row INSERTs
+        buffer = io.StringIO()
+        # Quote text so empty strings are not read back as NULL; bytea goes in hex form
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(
+            (cid, role, "\\x" + content.hex(), enc, ts, seq) for cid, role, content, enc, ts, seq in rows
+        )
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {Message.__tablename__} ({', '.join(_MESSAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+    else:
+        # Other PostgreSQL drivers (e.g. psycopg 3) have no copy_expert; SQLAlchemy's
+        # executemany takes mappings, so only this path builds dicts
+        session.execute(insert(Message), [dict(zip(_MESSAGE_COLUMNS, row)) for row in rows])
+    
+    if commit:
+        session.commit()
+
+
+def verify_many(messages: List[Message]) -> List[bool]:
+    """Verify many messages at once; large batches are checked in parallel"""
+    results = [True] * len(messages)
+    if not config.USE_DATABASE or fernet is None:
+        return results
+    
+    checked = [i for i, msg in enumerate(messages) if msg.encrypted]
+    for i, ok in zip(checked, _run_batched(_is_authentic, [messages[i].content for i in checked])):
+        results[i] = ok
+    return results
+
+
 def get_chat_history(session: Session, chat_id: int, limit: int = None) -> List[Dict[str, str]]:
     """Get chat history for a chat"""
-    query = session.query(Message).filter_by(chat_id=chat_id).order_by(Message.sequence)
+    # Plain column rows; ORM instances are never needed here
+    query = (
+        select(Message.role, Message.content, Message.encrypted)
+        .where(Message.chat_id == chat_id)
+        .order_by(Message.sequence)
+    )
     
     if limit:
         query = query.limit(limit)
     
-    messages = query.all()
-    history = []
+    rows = session.execute(query).all()
+    contents = [content for _, content, _ in rows]
     
-    for msg in messages:
-        history.append({
-            "role": msg.role,
-            "text": msg.get_content()
-        })
+    # Decrypt all encrypted rows in one batch instead of one by one
+    if config.USE_DATABASE and fernet is not None:
+        encrypted = [i for i, (_, content, is_encrypted) in enumerate(rows) if is_encrypted and content]
+        decrypted = _decrypt_many([contents[i] for i in encrypted])
+        for i, plain in zip(encrypted, decrypted):
+            contents[i] = plain
     
-    return history
+    return [{"role": role, "text": content.decode()} for (role, _, _), content in zip(rows, contents)]
 
 
 def reset_chat_history(session: Session, chat_id: int) -> None:
     """Reset chat history, keeping only system message"""
-    # Keep system message
-    system_msg = session.query(Message).filter_by(
-        chat_id=chat_id, 
-        role="system"
-    ).order_by(Message.sequence).first()
-    
-    # Delete all other messages
-    session.query(Message).filter(
-        Message.chat_id == chat_id,
-        Message.role != "system"
-    ).delete()
+    # One server-side DELETE; no rows are loaded into the session
+    session.execute(
+        delete(Message)
+        .where(Message.chat_id == chat_id, Message.role != "system")
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+
+def _increment_daily_counter(session: Session, model, chat_id: int, daily_limit: int) -> bool:
+    """Atomically increments today's counter row unless it reached the limit"""
+    if daily_limit <= 0:
+        return False
+    today = datetime.datetime.utcnow().date()
+    today_start = datetime.datetime.combine(today, datetime.time.min)
     
+    # INSERT ... ON CONFLICT DO UPDATE ... WHERE count < limit RETURNING count:
+    # one round trip, and concurrent requests cannot both take the last slot
+    stmt = pg_insert(model).values(chat_id=chat_id, date=today_start, date_bucket=today, count=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.chat_id, model.date_bucket],
+        set_={"count": model.count + 1},
+        where=model.count < daily_limit,
+    ).returning(model.count)
+    count = session.execute(stmt).scalar()
     session.commit()
+    # No row comes back when the WHERE rejected the update, i.e. the limit is reached
+    return count is not None
 
 
 def check_and_increment_usage(session: Session, chat_id: int, daily_limit: int) -> bool:
@@ -287,27 +642,7 @@ def check_and_increment_usage(session: Session, chat_id: int, daily_limit: int)
     if chat.is_unlimited:
         return True
     
-    today = datetime.datetime.utcnow().date()
-    today_start = datetime.datetime.combine(today, datetime.time.min)
-    
-    # Get today's usage
-    usage = session.query(UsageRecord).filter(
-        UsageRecord.chat_id == chat_id,
-        UsageRecord.date >= today_start
-    ).first()
-    
-    if not usage:
-        usage = UsageRecord(chat_id=chat_id, date=today_start, count=0)
-        session.add(usage)
-    
-    # Check limit
-    if usage.count >= daily_limit:
-        return False
-    
-    # Increment
-    usage.count += 1
-    session.commit()
-    return True
+    return _increment_daily_counter(session, UsageRecord, chat_id, daily_limit)
 
 
 def check_and_increment_image_usage(session: Session, chat_id: int, daily_limit: int) -> bool:
@@ -318,27 +653,33 @@ def check_and_increment_image_usage(session: Session, chat_id: int, daily_limit:
     if chat.is_unlimited:
         return True
     
-    today = datetime.datetime.utcnow().date()
-    today_start = datetime.datetime.combine(today, datetime.time.min)
-    
-    # Get today's usage
-    usage = session.query(ImageUsageRecord).filter(
-        ImageUsageRecord.chat_id == chat_id,
-        ImageUsageRecord.date >= today_start
-    ).first()
-    
-    if not usage:
-        usage = ImageUsageRecord(chat_id=chat_id, date=today_start, count=0)
-        session.add(usage)
-    
-    # Check limit
-    if usage.count >= daily_limit:
-        return False
-    
-    # Increment
-    usage.count += 1
-    session.commit()
-    return True
+    return _increment_daily_counter(session, ImageUsageRecord, chat_id, daily_limit)
+
+
+def _set_daily_counter(session: Session, model, chat_id: int, day: datetime.date, count: int, commit: bool = True) -> None:
+    """Sets the counter row for the given day to count, creating it if needed"""
+    # The counter references the chat, which may not exist yet
+    _ensure_chat(session, chat_id)
+    stmt = pg_insert(model).values(
+        chat_id=chat_id, date=datetime.datetime.combine(day, datetime.time.min), date_bucket=day, count=count
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.chat_id, model.date_bucket],
+        set_={"count": stmt.excluded.count},
+    )
+    session.execute(stmt)
+    if commit:
+        session.commit()
+
+
+def set_usage_count(session: Session, chat_id: int, day: datetime.date, count: int, commit: bool = True) -> None:
+    """Set the request counter of a chat for a day"""
+    _set_daily_counter(session, UsageRecord, chat_id, day, count, commit)
+
+
+def set_image_usage_count(session: Session, chat_id: int, day: datetime.date, count: int, commit: bool = True) -> None:
+    """Set the image generation counter of a chat for a day"""
+    _set_daily_counter(session, ImageUsageRecord, chat_id, day, count, commit)
 
 
 def set_unlimited_status(session: Session, chat_id: int, is_unlimited: bool) -> None:
@@ -348,25 +689,48 @@ def set_unlimited_status(session: Session, chat_id: int, is_unlimited: bool) ->
     session.commit()
 
 
+def set_unlimited_status_bulk(session: Session, chat_ids: List[int], commit: bool = True) -> None:
+    """Mark many chats as unlimited with a single UPSERT, creating missing chats"""
+    if not chat_ids:
+        return
+    # ON CONFLICT DO UPDATE fails if one statement touches the same row twice
+    chat_ids = dict.fromkeys(chat_ids)
+    stmt = pg_insert(Chat).values([{"chat_id": chat_id, "is_unlimited": True} for chat_id in chat_ids])
+    stmt = stmt.on_conflict_do_update(index_elements=[Chat.chat_id], set_={"is_unlimited": True})
+    session.execute(stmt)
+    if commit:
+        session.commit()
+
+
 def load_unlimited_ids(session: Session) -> List[int]:
     """Load all chat IDs with unlimited status"""
-    chats = session.query(Chat).filter_by(is_unlimited=True).all()
-    return [chat.chat_id for chat in chats]
+    return list(session.scalars(select(Chat.chat_id).where(Chat.is_unlimited.is_(True))))
 
 
 def update_chat_user_info(session: Session, chat_id: int, username=None, first_name=None, title=None):
     """Update username, first_name, and title for a chat if they have changed"""
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    if not chat:
-        chat = Chat(chat_id=chat_id)
-        session.add(chat)
-    changed = chat.update_user_info(username=username, first_name=first_name, title=title)
-    if changed:
-        session.commit()
+    # None means "unknown", so only the given fields are written
+    fields = {
+        name: value
+        for name, value in (("username", username), ("first_name", first_name), ("title", title))
+        if value is not None
+    }
+    # A single UPSERT; the WHERE makes it a server-side no-op when nothing changed
+    stmt = pg_insert(Chat).values(chat_id=chat_id, **fields)
+    if fields:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Chat.chat_id],
+            set_={**{name: stmt.excluded[name] for name in fields}, "updated_at": datetime.datetime.utcnow()},
+            where=or_(*(getattr(Chat, name).is_distinct_from(stmt.excluded[name]) for name in fields)),
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[Chat.chat_id])
+    session.execute(stmt)
+    session.commit()
 
 
-def add_usage_record(session: Session, chat_id: int, user_id: int = None, user_username: str = None, user_first_name: str = None, date: datetime.datetime = None, count: int = 1):
-    """Add a usage record with optional user details"""
+def add_usage_record(session: Session, chat_id: int, user_id: int = None, user_username: str = None, user_first_name: str = None, date: datetime.datetime = None, count: int = 1, commit: bool = True):
+    """Add a usage record with optional user details; with commit=False the caller commits"""
     if date is None:
         date = datetime.datetime.utcnow()
     usage = UsageRecord(
@@ -378,5 +742,6 @@ def add_usage_record(session: Session, chat_id: int, user_id: int = None, user_u
         count=count
     )
     session.add(usage)
-    session.commit()
+    if commit:
+        session.commit()
     return usage
\ No newline at end of file
@@ -1,19 +1,68 @@
-import io
+import asyncio
 import logging
 from telegram import Update, constants
 from telegram.ext import ContextTypes
+from . import state
 from .state import (
-    PROMPTS, HISTORIES, UNLIMITED_IDS, _save_state, _ensure_context, _truncate_history,
-    _check_and_increment_usage, _check_and_increment_image_usage, _add_message_to_history,
-    _reset_chat_history
+    PROMPTS, mark_state_dirty, _ensure_context,
+    _check_and_increment_usage, _check_and_increment_image_usage, _record_exchange,
+    _reset_chat_history, _set_prompt, _open_session, _close_session, shared_db_session
 )
 from .config import UNLIMITED_IDS_PATH, MAX_QUESTION_LEN, USE_DATABASE, ADMIN_CHAT_IDS
 from .yaclient import generate_reply, generate_image
-from .db import update_chat_user_info, Session, add_usage_record, set_system_prompt
+from .db import update_chat_user_info, add_usage_record, set_system_prompt
 
 # Import admin message handler
 from .admin_panel import admin_message_handler
 
+async def _run_blocking(func, *args, **kwargs):
+    """Runs state work in a worker thread when it goes to the database, so the event loop stays free"""
+    if USE_DATABASE:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    # The in-memory stores are only ever touched from the event loop
+    return func(*args, **kwargs)
+
+def _save_chat_info(chat, user=None) -> None:
+    """Stores the chat's username, first name and title, plus a usage record when a user is given"""
+    session = _open_session()
+    try:
+        update_chat_user_info(
+            session, chat.id,
+            username=getattr(chat, 'username', None),
+            first_name=getattr(chat, 'first_name', None),
+            title=getattr(chat, 'title', None),
+        )
+        if user is not None:
+            add_usage_record(session, chat.id, user_id=user.id, user_username=getattr(user, 'username', None), user_first_name=getattr(user, 'first_name', None))
+    finally:
+        _close_session(session)
+
+def _admit_request(chat, check_limit, user=None) -> bool:
+    """Saves the chat info and counts the request against the daily limit, sharing one session"""
+    with shared_db_session():
+        if USE_DATABASE:
+            _save_chat_info(chat, user)
+        return check_limit(chat.id)
+
+def _replace_prompt(chat_id: int, prompt: str) -> None:
+    """Resets the chat history and stores the new system prompt"""
+    with shared_db_session():
+        _reset_chat_history(chat_id)
+        if USE_DATABASE:
+            session = _open_session()
+            try:
+                set_system_prompt(session, chat_id, prompt)
+            finally:
+                _close_session(session)
+        # Recreate context with new prompt
+        _ensure_context(chat_id)
+
+def _reset_context(chat_id: int) -> None:
+    """Clears the chat history and recreates the context"""
+    with shared_db_session():
+        _reset_chat_history(chat_id)
+        _ensure_context(chat_id)
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Restrict access to whitelist
     user_id = update.effective_user.id
@@ -47,14 +96,7 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     chat_id = update.effective_chat.id
-    if USE_DATABASE:
-        session = Session()
-        chat = update.effective_chat
-        username = getattr(chat, 'username', None)
-        first_name = getattr(chat, 'first_name', None)
-        title = getattr(chat, 'title', None)
-        update_chat_user_info(session, chat_id, username=username, first_name=first_name, title=title)
-    if not _check_and_increment_usage(chat_id):
+    if not await _run_blocking(_admit_request, update.effective_chat, _check_and_increment_usage):
         await update.effective_message.reply_text("🚫 The daily limit of 15 requests has been reached. Please try again tomorrow.")
         return
     question = " ".join(context.args).strip()
@@ -66,31 +108,21 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(question) > MAX_QUESTION_LEN:
         await update.effective_message.reply_text("⚠️ The question is too long (max 4000 characters).")
         return
-    history = _ensure_context(chat_id)
-    if USE_DATABASE:
-        _add_message_to_history(chat_id, "user", question)
-    else:
-        history.append({"role": "user", "text": question})
-        _truncate_history(history)
+    # The question is stored together with the answer once the reply arrives
+    history = await _run_blocking(_ensure_context, chat_id)
+    history.append({"role": "user", "text": question})
     typing_task = context.application.create_task(update.effective_chat.send_chat_action("typing"))
     try:
         answer = await generate_reply(history)
-        if USE_DATABASE:
-            user = update.effective_user
-            add_usage_record(session, chat_id, user_id=user.id, user_username=getattr(user, 'username', None), user_first_name=getattr(user, 'first_name', None))
     except Exception as exc:
         logging.exception("YandexGPT request failed")
         await update.effective_message.reply_text(f"⚠️ Error: {exc}")
         return
     finally:
         typing_task.cancel()
-        if USE_DATABASE:
-            session.close()
-    if USE_DATABASE:
-        _add_message_to_history(chat_id, "assistant", answer)
-    else:
-        history.append({"role": "assistant", "text": answer})
-        _save_state()
+    # Only queues the database write, so the reply is not held up by the commit
+    _record_exchange(chat_id, question, answer, user=update.effective_user)
+    mark_state_dirty("histories")
     await update.effective_message.reply_text(answer, reply_to_message_id=update.message.message_id, parse_mode=None)
 
 async def setprompt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -106,16 +138,10 @@ async def setprompt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     # Update chat info in DB
     if USE_DATABASE:
-        session = Session()
-        chat = update.effective_chat
-        username = getattr(chat, 'username', None)
-        first_name = getattr(chat, 'first_name', None)
-        title = getattr(chat, 'title', None)
-        update_chat_user_info(session, chat_id, username=username, first_name=first_name, title=title)
-        session.close()
+        await asyncio.to_thread(_save_chat_info, update.effective_chat)
 
     # Access check
-    is_unlimited = chat_id in UNLIMITED_IDS
+    is_unlimited = chat_id in state.UNLIMITED_IDS
     is_admin = user_id in ADMIN_CHAT_IDS
     if not (is_unlimited or is_admin):
         await update.effective_message.reply_text("🚫 Access denied. Only administrators and whitelisted chats can set system prompt.")
@@ -128,30 +154,16 @@ async def setprompt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     # Save prompt in memory for non-DB mode
-    PROMPTS[chat_id] = new_prompt
+    _set_prompt(chat_id, new_prompt)
 
     try:
         logging.info(f"Setting system prompt for chat {chat_id}")
         
-        # Reset chat history
-        _reset_chat_history(chat_id)
+        # Reset chat history and store the prompt
+        await _run_blocking(_replace_prompt, chat_id, new_prompt)
         
-        # Update or create new context with prompt
-        if USE_DATABASE:
-            # Import inside function to avoid circular imports
-            from yandexgpt_bot.db import set_system_prompt as db_set_prompt
-            session = Session()
-            db_set_prompt(session, chat_id, new_prompt)
-            session.close()
-        else:
-            # For non-DB mode
-            HISTORIES[chat_id] = [{"role": "system", "text": new_prompt}]
-            
-        # Save state if not using DB
-        _save_state()
-        
-        # Recreate context with new prompt
-        _ensure_context(chat_id)
+        # Persist state if not using DB
+        mark_state_dirty("prompts", "histories")
         
         # Send confirmation
         await update.effective_message.reply_text("✅ System prompt updated and context reset.")
@@ -172,26 +184,17 @@ async def reset_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     # Update chat info in DB
     if USE_DATABASE:
-        session = Session()
-        chat = update.effective_chat
-        username = getattr(chat, 'username', None)
-        first_name = getattr(chat, 'first_name', None)
-        title = getattr(chat, 'title', None)
-        update_chat_user_info(session, chat_id, username=username, first_name=first_name, title=title)
-        session.close()
+        await asyncio.to_thread(_save_chat_info, update.effective_chat)
     
     try:
         # Remove custom prompt from memory
         PROMPTS.pop(chat_id, None)
         
-        # Use history reset function with DB support
-        _reset_chat_history(chat_id)
+        # Reset history (with DB support) and force a new context with default prompt
+        await _run_blocking(_reset_context, chat_id)
         
-        # Force create new context with default prompt
-        _ensure_context(chat_id)
-        
-        # Save state if not using DB
-        _save_state()
+        # Persist state if not using DB
+        mark_state_dirty("prompts", "histories")
         
         await update.effective_message.reply_text("🗑️ Context cleared. Default prompt is used.")
     except Exception as e:
@@ -212,18 +215,7 @@ async def image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not description:
         await update.effective_message.reply_text("Usage: /image <description>")
         return
-    chat_id = update.effective_chat.id
-    if USE_DATABASE:
-        session = Session()
-        chat = update.effective_chat
-        username = getattr(chat, 'username', None)
-        first_name = getattr(chat, 'first_name', None)
-        title = getattr(chat, 'title', None)
-        update_chat_user_info(session, chat_id, username=username, first_name=first_name, title=title)
-        user = update.effective_user
-        add_usage_record(session, chat_id, user_id=user.id, user_username=getattr(user, 'username', None), user_first_name=getattr(user, 'first_name', None))
-        session.close()
-    if not _check_and_increment_image_usage(chat_id):
+    if not await _run_blocking(_admit_request, update.effective_chat, _check_and_increment_image_usage, update.effective_user):
         await update.effective_message.reply_text("🚫 The daily image generation limit of 5 requests has been reached. Please try again tomorrow.")
         return
     typing_task = context.application.create_task(update.effective_chat.send_chat_action("upload_photo"))
@@ -235,7 +227,8 @@ async def image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     finally:
         typing_task.cancel()
-    await update.effective_message.reply_photo(photo=io.BytesIO(image_bytes))
+    # PTB uploads raw bytes directly; wrapping them in BytesIO only adds a copy
+    await update.effective_message.reply_photo(photo=image_bytes)
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles regular text messages and contacts"""
@@ -2,30 +2,49 @@
 """
 Database initialization script for YandexGPT bot.
 Этот скрипт пересоздаёт все таблицы. После добавления username/first_name/title в Chat обязательно запустите его для применения изменений в схеме БД!
+With --upgrade the tables are kept and only the schema changes that create_all
+cannot apply to existing tables are made; run it once after updating the bot.
 """
 import sys
 import logging
+import argparse
 from pathlib import Path
-from sqlalchemy import create_engine
 
 # Добавляем родительский каталог в путь Python
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 # Прямые импорты из модуля
 from yandexgpt_bot import config
-from yandexgpt_bot.db import Base
 
 def main():
+    parser = argparse.ArgumentParser(description="Create or upgrade the bot's database schema")
+    parser.add_argument(
+        "--upgrade", action="store_true",
+        help="keep existing tables and data, only add missing columns and indexes",
+    )
+    args = parser.parse_args()
+    
     if not config.USE_DATABASE:
         print("Database usage is disabled in config.yaml. Set use_database: true to enable.")
         return
     
+    # SQLAlchemy is only needed when the database is enabled
+    from sqlalchemy import create_engine
+    from yandexgpt_bot.db import Base, upgrade_schema
+    
     print("Initializing database...")
     
     try:
         # Создаем подключение к базе данных
         engine = create_engine(config.DB_URL)
         
+        if args.upgrade:
+            print("Upgrading schema in place...")
+            Base.metadata.create_all(engine)
+            upgrade_schema(engine)
+            print("Database schema upgraded successfully!")
+            return
+        
         # Пересоздаем все таблицы
         print("Dropping all tables...")
         Base.metadata.drop_all(engine)
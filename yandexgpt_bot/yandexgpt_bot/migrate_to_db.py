@@ -7,9 +7,28 @@ and populate the database with their data.
 import sys
 import json
 import logging
+import argparse
 import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from sqlalchemy import text
+from sqlalchemy.orm import scoped_session
+
+# orjson is optional: it parses state.json much faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson is optional: with it, state.json sections are streamed instead of
+# loading the whole file into memory
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # Add parent directory to path to import the bot package
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
@@ -17,132 +36,314 @@ from yandexgpt_bot.config import USE_DATABASE, STATE_FILE, UNLIMITED_IDS_PATH
 # Импортируем только db модуль, а не его функции
 from yandexgpt_bot import db
 
+log = logging.getLogger(__name__)
+
 def load_state_from_file():
     """Load state from JSON file"""
     if not STATE_FILE.exists():
-        print(f"State file {STATE_FILE} does not exist.")
+        log.warning("State file %s does not exist.", STATE_FILE)
         return None
     
     try:
+        if orjson is not None:
+            return orjson.loads(STATE_FILE.read_bytes())
         with open(STATE_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
     except Exception as e:
-        print(f"Error loading state file: {e}")
+        log.error("Error loading state file: %s", e)
         return None
 
+def iter_state_section(state_data, name):
+    """Yields the (chat_id, value) pairs of one state.json section"""
+    if state_data is not None:
+        yield from state_data.get(name, {}).items()
+        return
+    # Streaming: only the current chat's entry is held in memory
+    with open(STATE_FILE, 'rb') as f:
+        yield from ijson.kvitems(f, name)
+
 def load_unlimited_ids_from_file():
     """Load unlimited IDs from file"""
     if not UNLIMITED_IDS_PATH.exists():
-        print(f"Unlimited IDs file {UNLIMITED_IDS_PATH} does not exist.")
+        log.warning("Unlimited IDs file %s does not exist.", UNLIMITED_IDS_PATH)
         return []
     
     try:
-        with open(UNLIMITED_IDS_PATH, 'r', encoding='utf-8') as f:
-            return [int(line.strip()) for line in f if line.strip().isdigit()]
+        ids = []
+        append = ids.append
+        # One read and one C-level split instead of iterating the file line by line;
+        # int() validates each token itself and, unlike isdigit(), accepts the
+        # negative IDs of group chats that the bot also reads from this file
+        for token in UNLIMITED_IDS_PATH.read_bytes().split():
+            try:
+                append(int(token))
+            except ValueError:
+                log.warning("Skipping invalid line in unlimited IDs file: %s", token.decode(errors='replace'))
+        # Listing a chat twice must not cost a second write
+        return list(dict.fromkeys(ids))
     except Exception as e:
-        print(f"Error loading unlimited IDs file: {e}")
+        log.error("Error loading unlimited IDs file: %s", e)
         return []
 
-def migrate_data():
+def parse_history_entry(message):
+    """Returns (role, text) for a history entry in either state.json format"""
+    if isinstance(message, dict):
+        # Missing fields come back as None, which the caller's truthiness check skips
+        return message.get("role"), message.get("text")
+    return message[0], message[1]
+
+def parse_usage_entry(usage_data):
+    """Returns (date, count) for a usage entry in either state.json format"""
+    # The bot stores counters packed as (day ordinal << 32) | count;
+    # older state files use [iso_date, count]
+    if isinstance(usage_data, list):
+        date_str, count = usage_data
+        return datetime.datetime.fromisoformat(date_str).date(), count
+    return datetime.date.fromordinal(usage_data >> 32), usage_data & 0xFFFFFFFF
+
+def skip_wal_flush(session):
+    """Lets the session's current transaction commit without waiting for the WAL flush"""
+    # Safe for a migration, which is simply rerun if lost. SET LOCAL ends with the
+    # transaction, so it must be repeated after every commit, but it never leaks
+    # into the pooled connection
+    session.execute(text("SET LOCAL synchronous_commit = off"))
+
+def open_migration_session():
+    """Opens a session tuned for bulk writes that are never read back"""
+    session = db.Session()
+    # Nothing here reads back what it wrote, so autoflush would only add work
+    session.autoflush = False
+    skip_wal_flush(session)
+    return session
+
+# Histories are written in batches of about this many messages; each batch is
+# one COPY on PostgreSQL
+HISTORY_BATCH_MESSAGES = 10000
+
+def prepare_chat_history(chat_id_str, messages, prompts):
+    """Returns (chat_id, start_sequence, turns) for one chat's saved history"""
+    chat_id = int(chat_id_str)
+    turns = [(role, text) for role, text in map(parse_history_entry, messages) if role and text]
+    start_sequence = 0
+    # The bot keeps the system prompt out of the saved history, but the
+    # database history starts with it at sequence 0
+    if turns and turns[0][0] != "system":
+        if chat_id_str in prompts:
+            turns.insert(0, ("system", prompts[chat_id_str]))
+        else:
+            # Left free for the default prompt the bot adds on first use
+            start_sequence = 1
+    log.debug("Migrating %d messages for chat ID %d", len(messages), chat_id)
+    return chat_id, start_sequence, turns
+
+def migrate_histories_parallel(histories, prompts, workers):
+    """Writes chat histories from several threads, each with its own session and transaction"""
+    # scoped_session hands every worker thread its own session
+    worker_session = scoped_session(open_migration_session)
+    sessions = []
+    
+    def migrate_one(item):
+        session = worker_session()
+        if session not in sessions:
+            sessions.append(session)
+        db.bulk_add_histories(session, [prepare_chat_history(item[0], item[1], prompts)], commit=False)
+        return len(item[1])
+    
+    chat_count = message_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Submitted in windows, so a streamed state file is not read ahead in full
+            while window := list(itertools.islice(histories, workers * 16)):
+                counts = list(executor.map(migrate_one, window))
+                chat_count += len(counts)
+                message_count += sum(counts)
+        for session in sessions:
+            session.commit()
+    except Exception:
+        for session in sessions:
+            session.rollback()
+        raise
+    finally:
+        for session in sessions:
+            session.close()
+    return chat_count, message_count
+
+def is_usage_from(usage_data, day):
+    """Tells whether a usage entry counts the given day, without fully parsing it"""
+    if isinstance(usage_data, list):
+        # ISO dates start with YYYY-MM-DD, so a prefix check avoids fromisoformat
+        return usage_data[0].startswith(day.isoformat())
+    return usage_data >> 32 == day.toordinal()
+
+def migrate_unlimited_ids(session):
+    """Marks the chats from unlimited_chats.txt as unlimited"""
+    unlimited_ids = load_unlimited_ids_from_file()
+    db.set_unlimited_status_bulk(session, unlimited_ids, commit=False)
+    log.info("Set unlimited status for %d chats", len(unlimited_ids))
+
+def migrate_prompts(session, state_data):
+    """Stores the custom system prompts; returns them keyed by the chat ID string"""
+    prompts = dict(iter_state_section(state_data, "prompts"))
+    # Keyed by the parsed ID, so spellings of the same chat collapse into one row
+    db.set_system_prompts_bulk(
+        session, {int(chat_id_str): prompt for chat_id_str, prompt in prompts.items()}, commit=False
+    )
+    log.info("Migrated %d system prompts", len(prompts))
+    return prompts
+
+def migrate_histories(session, state_data, prompts, workers):
+    """Stores the chat histories, in batches or from several threads"""
+    histories = iter_state_section(state_data, "histories")
+    if workers > 1:
+        # Workers would block on the chat rows this transaction has not committed yet
+        session.commit()
+        # The usage upserts that follow run in a new transaction
+        skip_wal_flush(session)
+        chat_count, message_count = migrate_histories_parallel(histories, prompts, workers)
+    else:
+        chat_count = message_count = 0
+        batch, batch_messages = [], 0
+        for chat_id_str, messages in histories:
+            batch.append(prepare_chat_history(chat_id_str, messages, prompts))
+            batch_messages += len(messages)
+            chat_count += 1
+            message_count += len(messages)
+            # One COPY (or multi-row INSERT) per batch of chats instead of one INSERT per message
+            if batch_messages >= HISTORY_BATCH_MESSAGES:
+                db.bulk_add_histories(session, batch, commit=False)
+                batch, batch_messages = [], 0
+        db.bulk_add_histories(session, batch, commit=False)
+    log.info("Migrated %d messages in %d chats", message_count, chat_count)
+
+def migrate_usage(session, state_data, section, set_count, today):
+    """Stores today's counters from a usage section with the given db setter"""
+    migrated = 0
+    for chat_id_str, usage_data in iter_state_section(state_data, section):
+        # Skip if not today (we only care about today's usage for rate limiting)
+        if not is_usage_from(usage_data, today):
+            continue
+        date, count = parse_usage_entry(usage_data)
+        if count:
+            chat_id = int(chat_id_str)
+            # One upsert sets the counter instead of incrementing it count times
+            set_count(session, chat_id, date, count, commit=False)
+            migrated += 1
+            log.debug("Migrated %s count of %d for chat ID %d", section, count, chat_id)
+    log.info("Migrated today's %s counters of %d chats", section, migrated)
+
+def load_state_for_migration():
+    """Returns (found, state_data); state_data is None when the file will be streamed"""
+    if ijson is not None and STATE_FILE.exists():
+        return True, None
+    state_data = load_state_from_file()
+    return bool(state_data), state_data
+
+def count_migration(state_data):
+    """Walks the migration input without touching the database; returns what would be written"""
+    prompts = dict(iter_state_section(state_data, "prompts"))
+    counts = {"unlimited_ids": len(load_unlimited_ids_from_file()), "prompts": len(prompts), "chats": 0, "messages": 0}
+    for chat_id_str, messages in iter_state_section(state_data, "histories"):
+        # Runs the same parsing as the real migration, so bad rows fail here too
+        _, _, turns = prepare_chat_history(chat_id_str, messages, prompts)
+        counts["chats"] += 1
+        counts["messages"] += len(turns)
+    today = datetime.datetime.utcnow().date()
+    for section in ("daily_usage", "image_usage"):
+        counts[section] = 0
+        for chat_id_str, usage_data in iter_state_section(state_data, section):
+            if is_usage_from(usage_data, today) and parse_usage_entry(usage_data)[1]:
+                int(chat_id_str)  # the real migration parses the key too
+                counts[section] += 1
+    return counts
+
+def migrate_data(workers=1, dry_run=False):
     """Migrate data from files to database"""
+    if dry_run:
+        # Only the files are read, so no database connection is needed
+        found, state_data = load_state_for_migration()
+        if not found:
+            log.warning("No state data to migrate.")
+            return False
+        try:
+            counts = count_migration(state_data)
+        except Exception as e:
+            log.error("Error reading migration data: %s", e)
+            return False
+        log.info("Dry run, nothing written: %s", json.dumps(counts))
+        return True
+    
     if not USE_DATABASE:
-        print("Database usage is disabled in config.yaml. Set use_database: true to enable.")
+        log.error("Database usage is disabled in config.yaml. Set use_database: true to enable.")
         return False
     
     # Initialize database
     if not db.init_db():
-        print("Failed to initialize database. Check connection parameters in config.yaml")
+        log.error("Failed to initialize database. Check connection parameters in config.yaml")
         return False
     
     # Проверяем, что Session существует после инициализации
     if db.Session is None:
-        print("Database session initialization failed. Session is None.")
+        log.error("Database session initialization failed. Session is None.")
         return False
     
-    # Start a session
-    session = db.Session()
+    # Start a session; every helper below is called with commit=False, so the
+    # whole migration is one transaction with a single commit at the end. With
+    # --workers above 1 it is split: this session commits the whitelist and
+    # prompts before the histories, which the workers write and commit in their
+    # own transactions, and then commits the usage counters at the end
+    session = open_migration_session()
     
     try:
-        # Load state from file
-        state_data = load_state_from_file()
-        if not state_data:
-            print("No state data to migrate.")
+        # Load state from file, or leave it to be streamed section by section
+        found, state_data = load_state_for_migration()
+        if not found:
+            log.warning("No state data to migrate.")
             return False
         
-        # Migrate unlimited IDs
-        unlimited_ids = load_unlimited_ids_from_file()
-        for chat_id in unlimited_ids:
-            db.set_unlimited_status(session, chat_id, True)
-            print(f"Set unlimited status for chat ID {chat_id}")
-        
-        # Migrate prompts
-        prompts = state_data.get("prompts", {})
-        for chat_id_str, prompt in prompts.items():
-            chat_id = int(chat_id_str)
-            db.set_system_prompt(session, chat_id, prompt)
-            print(f"Migrated system prompt for chat ID {chat_id}")
-        
-        # Migrate chat histories
-        histories = state_data.get("histories", {})
-        for chat_id_str, messages in histories.items():
-            chat_id = int(chat_id_str)
-            for i, message in enumerate(messages):
-                role = message.get("role", "")
-                text = message.get("text", "")
-                if role and text:
-                    db.add_message(session, chat_id, role, text, sequence=i)
-            print(f"Migrated {len(messages)} messages for chat ID {chat_id}")
-        
-        # Migrate daily usage
-        daily_usage = state_data.get("daily_usage", {})
-        for chat_id_str, usage_data in daily_usage.items():
-            chat_id = int(chat_id_str)
-            date_str, count = usage_data
-            date = datetime.datetime.fromisoformat(date_str)
-            
-            # Skip if not today (we only care about today's usage for rate limiting)
-            if date.date() == datetime.datetime.utcnow().date():
-                # Add usage records manually to match the count
-                for i in range(count):
-                    db.check_and_increment_usage(session, chat_id, 9999)  # Use a high limit to ensure it succeeds
-                print(f"Migrated usage count of {count} for chat ID {chat_id}")
-        
-        # Migrate image usage
-        image_usage = state_data.get("image_usage", {})
-        for chat_id_str, usage_data in image_usage.items():
-            chat_id = int(chat_id_str)
-            date_str, count = usage_data
-            date = datetime.datetime.fromisoformat(date_str)
-            
-            # Skip if not today
-            if date.date() == datetime.datetime.utcnow().date():
-                # Add usage records manually to match the count
-                for i in range(count):
-                    db.check_and_increment_image_usage(session, chat_id, 9999)  # Use a high limit
-                print(f"Migrated image usage count of {count} for chat ID {chat_id}")
+        migrate_unlimited_ids(session)
+        prompts = migrate_prompts(session, state_data)
+        migrate_histories(session, state_data, prompts, workers)
+        # Only today's counters matter for rate limiting
+        today = datetime.datetime.utcnow().date()
+        migrate_usage(session, state_data, "daily_usage", db.set_usage_count, today)
+        migrate_usage(session, state_data, "image_usage", db.set_image_usage_count, today)
         
         session.commit()
-        print("Migration completed successfully!")
+        log.info("Migration committed")
         return True
     
     except Exception as e:
         session.rollback()
-        print(f"Error during migration: {e}")
+        log.error("Error during migration: %s", e)
         return False
     
     finally:
         session.close()
 
 def main():
-    print("Starting migration from JSON files to database...")
-    success = migrate_data()
+    parser = argparse.ArgumentParser(description="Migrate state.json and unlimited_chats.txt to the database")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="threads writing chat histories; above 1 each thread commits separately (default: 1)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="read and validate all data and report counts without writing to the database",
+    )
+    args = parser.parse_args()
+    
+    if args.dry_run:
+        sys.exit(0 if migrate_data(dry_run=True) else 1)
+    
+    log.info("Starting migration from JSON files to database...")
+    success = migrate_data(workers=args.workers)
     
     if success:
-        print("\nMigration completed successfully!")
-        print("You can now use the bot with the database backend.")
-        print("Tip: Backup your state.json and unlimited_chats.txt files before proceeding.")
+        log.info("Migration completed successfully!")
+        log.info("You can now use the bot with the database backend.")
+        log.info("Tip: Backup your state.json and unlimited_chats.txt files before proceeding.")
     else:
-        print("\nMigration failed. Please check the errors above.")
+        log.error("Migration failed. Please check the errors above.")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
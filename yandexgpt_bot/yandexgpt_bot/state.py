@@ -2,13 +2,30 @@
 State management for chat contexts, usage tracking, and unlimited access handling.
 Supports both database and in-memory implementations.
 """
+import asyncio
+import atexit
 import datetime as _dt
+from collections import OrderedDict, deque
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
-from yandexgpt_bot.config import STATE_FILE, UNLIMITED_IDS_PATH, DEFAULT_SYSTEM_PROMPT, USE_DATABASE
+from typing import Deque, Dict, FrozenSet, List, NamedTuple, Set
+from yandexgpt_bot.config import (
+    STATE_FILE, STATE_FLUSH_INTERVAL, UNLIMITED_IDS_PATH, DEFAULT_SYSTEM_PROMPT, USE_DATABASE, MAX_HISTORY_TURNS,
+    MAX_CACHED_CHATS, DAILY_LIMIT, IMAGE_GENERATION_LIMIT, UNLIMITED_REFRESH_INTERVAL
+)
 import logging
 
+# orjson is optional: it is much faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Default placeholders for database functions when DB is disabled or uninitialized
 db_initialized = False
 Session = None
@@ -18,10 +35,14 @@ get_or_create_chat = None
 set_system_prompt = None
 get_system_prompt = None
 add_message = None
+bulk_add_histories = None
+next_sequences = None
 get_chat_history = None
 reset_chat_history = None
 check_and_increment_usage = None
 check_and_increment_image_usage = None
+add_usage_record = None
+is_disconnect_error = None
 
 # Import database module if database is enabled
 if USE_DATABASE:
@@ -38,18 +59,39 @@ if USE_DATABASE:
         set_system_prompt = db.set_system_prompt
         get_system_prompt = db.get_system_prompt
         add_message = db.add_message
+        bulk_add_histories = db.bulk_add_histories
+        next_sequences = db.next_sequences
         get_chat_history = db.get_chat_history
         reset_chat_history = db.reset_chat_history
         check_and_increment_usage = db.check_and_increment_usage
         check_and_increment_image_usage = db.check_and_increment_image_usage
+        add_usage_record = db.add_usage_record
+        is_disconnect_error = db.is_disconnect_error
 
 # In-memory state fallback when database is not used
 ChatContext = List[Dict[str, str]]
+
+class Turn(NamedTuple):
+    """A single dialogue turn; far smaller than a dict and stored as [role, text] in the state file"""
+    role: str
+    text: str
+
+# Custom system prompts are the only copy of each /setprompt value, so they are never evicted
 PROMPTS: Dict[int, str] = {}
-HISTORIES: Dict[int, ChatContext] = {}
-DAILY_USAGE: Dict[int, Tuple[_dt.date, int]] = {}
-DAILY_IMAGE_USAGE: Dict[int, Tuple[_dt.date, int]] = {}
-UNLIMITED_IDS: Set[int] = set()
+# Dialogue turns only; the system prompt lives in PROMPTS and is prepended per request.
+# Kept in least-recently-used order and capped at MAX_CACHED_CHATS, so memory use
+# and the size of each state write stay bounded
+HISTORIES: "OrderedDict[int, Deque[Turn]]" = OrderedDict()
+# Daily counters are packed into one int per chat: (day ordinal << 32) | count
+DAILY_USAGE: Dict[int, int] = {}
+DAILY_IMAGE_USAGE: Dict[int, int] = {}
+_COUNT_MASK = 0xFFFFFFFF
+
+# Today's date ordinal, refreshed by a background task so the rate limiter does
+# not build a new date object on every request
+_TODAY = _dt.date.today().toordinal()
+_TODAY_REFRESH_INTERVAL = 30
+UNLIMITED_IDS: FrozenSet[int] = frozenset()
 
 def _load_unlimited_ids() -> Set[int]:
     # If database is enabled and initialized, load from database
@@ -66,27 +108,68 @@ def _load_unlimited_ids() -> Set[int]:
     # File-based method
     if not UNLIMITED_IDS_PATH.exists():
         return set()
+    # bytes.split() tokenizes the whole file in C and skips blank lines for free
     ids: Set[int] = set()
-    for line in UNLIMITED_IDS_PATH.read_text().splitlines():
-        line = line.strip()
+    for token in UNLIMITED_IDS_PATH.read_bytes().split():
+        # int() does the validation, so tokens like b"--5" are skipped rather than raising
         try:
-            chat_id = int(line)
-            ids.add(chat_id)
-            
-            # Also update database if enabled
-            if USE_DATABASE and db_initialized and Session is not None and set_unlimited_status is not None:
-                try:
-                    db_session = Session()
-                    set_unlimited_status(db_session, chat_id, True)
-                    db_session.close()
-                except Exception as e:
-                    logging.error(f"Error setting unlimited status in database: {e}")
-                    
+            ids.add(int(token))
         except ValueError:
-            logging.warning(f"Skipping invalid line in unlimited_chats.txt: {line}")
+            logging.warning(f"Skipping invalid line in unlimited_chats.txt: {token.decode(errors='replace')}")
+    
+    # Also update database if enabled
+    if USE_DATABASE and db_initialized and Session is not None and set_unlimited_status is not None:
+        for chat_id in ids:
+            try:
+                db_session = Session()
+                set_unlimited_status(db_session, chat_id, True)
+                db_session.close()
+            except Exception as e:
+                logging.error(f"Error setting unlimited status in database: {e}")
     return ids
 
-UNLIMITED_IDS = _load_unlimited_ids()
+# Immutable for fast membership checks; other modules must read it as
+# state.UNLIMITED_IDS because updates rebind the name
+UNLIMITED_IDS = frozenset(_load_unlimited_ids())
+# Bumped on every local change, so a refresh that overlapped one can be discarded
+_unlimited_generation = 0
+
+def _update_unlimited_ids(chat_id: int, unlimited: bool) -> None:
+    """Adds or removes a chat from the in-memory unlimited set"""
+    global UNLIMITED_IDS, _unlimited_generation
+    _unlimited_generation += 1
+    if unlimited:
+        UNLIMITED_IDS = UNLIMITED_IDS | {chat_id}
+    else:
+        UNLIMITED_IDS = UNLIMITED_IDS - {chat_id}
+
+def _new_history(messages=()) -> Deque[Turn]:
+    """Creates a bounded dialogue history that drops the oldest turns on overflow"""
+    return deque(messages, maxlen=2 * MAX_HISTORY_TURNS)
+
+def _remember(store: OrderedDict, chat_id: int, value) -> None:
+    """Stores a value as most recently used, evicting the oldest chats past the cap"""
+    store[chat_id] = value
+    store.move_to_end(chat_id)
+    while len(store) > MAX_CACHED_CHATS:
+        store.popitem(last=False)
+
+def _set_prompt(chat_id: int, prompt: str) -> None:
+    """Sets the in-memory system prompt for a chat"""
+    PROMPTS[chat_id] = prompt
+
+def _load_message(value) -> Turn:
+    """Converts a persisted history entry to a Turn, accepting the old {"role", "text"} format"""
+    if isinstance(value, dict):
+        return Turn(value.get("role", ""), value.get("text", ""))
+    return Turn(*value)
+
+def _load_usage_counter(value) -> int:
+    """Converts a persisted usage counter to the packed form, accepting the old [date, count] format"""
+    if isinstance(value, list):
+        day = _dt.date.fromisoformat(value[0]).toordinal()
+        return (day << 32) | value[1]
+    return int(value)
 
 def _load_state() -> None:
     # Database is the source of truth when enabled
@@ -97,40 +180,214 @@ def _load_state() -> None:
     # File-based method
     if not STATE_FILE.exists():
         return
-    data = json.loads(STATE_FILE.read_text())
+    if orjson is not None:
+        data = orjson.loads(STATE_FILE.read_bytes())
+    else:
+        data = json.loads(STATE_FILE.read_text())
     for k, v in data.get("prompts", {}).items():
         PROMPTS[int(k)] = v
     for k, v in data.get("daily_usage", {}).items():
-        d = _dt.date.fromisoformat(v[0])
-        DAILY_USAGE[int(k)] = (d, v[1])
+        DAILY_USAGE[int(k)] = _load_usage_counter(v)
     for k, v in data.get("image_usage", {}).items():
-        d = _dt.date.fromisoformat(v[0])
-        DAILY_IMAGE_USAGE[int(k)] = (d, v[1])
+        DAILY_IMAGE_USAGE[int(k)] = _load_usage_counter(v)
     for k, v in data.get("histories", {}).items():
-        HISTORIES[int(k)] = v
+        # Older state files kept the system prompt as the first history entry
+        messages = map(_load_message, v)
+        HISTORIES[int(k)] = _new_history(m for m in messages if m.role != "system")
+    # The file may predate the cap or have been written with a larger one
+    while len(HISTORIES) > MAX_CACHED_CHATS:
+        HISTORIES.popitem(last=False)
+
+# Top-level sections of the state file and the stores they are written from
+_STATE_SECTIONS = {
+    "prompts": PROMPTS,
+    "daily_usage": DAILY_USAGE,
+    "image_usage": DAILY_IMAGE_USAGE,
+    "histories": HISTORIES,
+}
+
+# Last encoded form of each section. Only sections that changed since the
+# previous write are re-encoded; the rest are spliced in from here. Only the
+# state I/O thread (or the final synchronous flush) touches it
+_encoded_sections: Dict[str, bytes] = {}
+
+def _state_snapshot(sections) -> dict:
+    """Collects the given sections of the in-memory state into a serializable dict"""
+    # Both encoders stringify int keys themselves, so the stores are passed by
+    # reference instead of being rebuilt key by key. Shallow copies are cheap
+    # C-level dict copies and keep the encoder safe from chats being added
+    # while it runs in the I/O thread
+    # Sections never encoded yet are always included so the file is complete
+    names = set(sections) | (_STATE_SECTIONS.keys() - _encoded_sections.keys())
+    return {name: dict(_STATE_SECTIONS[name]) for name in names}
 
-def _save_state() -> None:
+def _encode_default(obj):
+    # Neither encoder supports deque, which HISTORIES uses. orjson also rejects
+    # NamedTuple, so each Turn is converted to a plain (role, text) tuple
+    if isinstance(obj, deque):
+        return list(map(tuple, obj))
+    raise TypeError
+
+def _encode_section(data: dict) -> bytes:
+    # Compact output: indentation roughly doubled the file size for long histories
+    if orjson is not None:
+        return orjson.dumps(data, default=_encode_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_encode_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def _write_state(data: dict) -> None:
+    """Encodes the changed sections and atomically replaces the state file"""
+    for name, section in data.items():
+        _encoded_sections[name] = _encode_section(section)
+    payload = b"{" + b",".join(
+        b'"%s":%s' % (name.encode(), _encoded_sections[name]) for name in _STATE_SECTIONS
+    ) + b"}"
+    # Write to a temporary file first so a crash never leaves a truncated state file
+    tmp_file = STATE_FILE.with_suffix(".tmp")
+    tmp_file.write_bytes(payload)
+    os.replace(tmp_file, STATE_FILE)
+
+def _save_state(sections=_STATE_SECTIONS) -> None:
     # If database is enabled, we don't need to save state to file
     if USE_DATABASE and db_initialized:
         return
         
     # File-based method
-    data = {
-        "prompts": {str(k): v for k, v in PROMPTS.items()},
-        "daily_usage": {str(k): [d.isoformat(), c] for k, (d, c) in DAILY_USAGE.items()},
-        "image_usage": {str(k): [d.isoformat(), c] for k, (d, c) in DAILY_IMAGE_USAGE.items()},
-        "histories": {str(k): v for k, v in HISTORIES.items()},
-    }
-    STATE_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2))
+    _write_state(_state_snapshot(sections))
+
+# Single worker: state writes never overlap, so no extra locking is needed
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-io")
+
+async def _save_state_async(sections=_STATE_SECTIONS) -> None:
+    """Like _save_state, but encodes and writes the file off the event loop"""
+    if USE_DATABASE and db_initialized:
+        return
+    # The snapshot is taken on the event loop; only encoding and I/O run in the thread
+    data = _state_snapshot(sections)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_io_pool, _write_state, data)
+
+# Debounced persistence: mutations only mark their sections dirty and a
+# background task writes them out at most once per STATE_FLUSH_INTERVAL seconds
+_dirty_sections: Set[str] = set()
+
+def mark_state_dirty(*sections: str) -> None:
+    """Schedule the given state sections (all if none are given) to be written on the next flush"""
+    _dirty_sections.update(sections or _STATE_SECTIONS)
+
+def flush_state() -> None:
+    """Write the state file now if anything changed since the last write"""
+    if not _dirty_sections:
+        return
+    sections = set(_dirty_sections)
+    _dirty_sections.clear()
+    try:
+        _save_state(sections)
+    except Exception as e:
+        _dirty_sections.update(sections)
+        logging.error(f"Error saving state: {e}")
+
+async def flush_state_async() -> None:
+    """Async variant of flush_state that writes via the state I/O thread"""
+    if not _dirty_sections:
+        return
+    sections = set(_dirty_sections)
+    _dirty_sections.clear()
+    try:
+        await _save_state_async(sections)
+    except Exception as e:
+        _dirty_sections.update(sections)
+        logging.error(f"Error saving state: {e}")
+
+async def _flush_state_periodically() -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        await flush_state_async()
+
+async def _refresh_today_periodically() -> None:
+    global _TODAY
+    while True:
+        await asyncio.sleep(_TODAY_REFRESH_INTERVAL)
+        _TODAY = _dt.date.today().toordinal()
+
+async def _refresh_unlimited_ids_periodically() -> None:
+    """Picks up whitelist changes made by other bot processes sharing the database"""
+    global UNLIMITED_IDS
+    while True:
+        await asyncio.sleep(UNLIMITED_REFRESH_INTERVAL)
+        generation = _unlimited_generation
+        try:
+            ids = frozenset(await asyncio.to_thread(_load_unlimited_ids))
+            # An admin change made while the query ran may be missing from the snapshot;
+            # the next refresh picks it up from the database
+            if generation == _unlimited_generation:
+                UNLIMITED_IDS = ids
+        except Exception as e:
+            logging.error(f"Error refreshing unlimited IDs: {e}")
+
+_background_tasks: List[asyncio.Task] = []
+
+async def start_background_tasks(application) -> None:
+    """PTB post_init hook: starts the state writer, the date refresher and, with a database, the whitelist refresher and exchange writer"""
+    global _TODAY
+    if _background_tasks:
+        return
+    _TODAY = _dt.date.today().toordinal()
+    _background_tasks.append(asyncio.create_task(_flush_state_periodically()))
+    _background_tasks.append(asyncio.create_task(_refresh_today_periodically()))
+    if USE_DATABASE and db_initialized:
+        _background_tasks.append(asyncio.create_task(_refresh_unlimited_ids_periodically()))
+        _background_tasks.append(asyncio.create_task(_write_exchanges_continuously()))
+
+async def stop_background_tasks(application) -> None:
+    """PTB post_stop hook: stops background tasks and flushes pending changes and queued exchanges"""
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    await _drain_pending_exchanges()
+    # Goes through the same single-worker pool, so it runs after any in-flight write
+    await flush_state_async()
+
+atexit.register(flush_state)
+
+# Handlers can group several state calls into one database session with
+# shared_db_session(); helpers pick it up from this context variable. Worker
+# threads started by asyncio.to_thread inherit the caller's context
+_shared_session: ContextVar = ContextVar("_shared_session", default=None)
+
+def _open_session():
+    """Returns the session of the enclosing shared_db_session block, or a new one"""
+    db_session = _shared_session.get()
+    return db_session if db_session is not None else Session()
+
+def _close_session(db_session) -> None:
+    """Closes a session from _open_session unless it belongs to a shared_db_session block"""
+    if db_session is not _shared_session.get():
+        db_session.close()
+
+@contextmanager
+def shared_db_session():
+    """Makes every state helper called inside the block reuse one database session"""
+    if not (USE_DATABASE and db_initialized and Session is not None) or _shared_session.get() is not None:
+        yield
+        return
+    db_session = Session()
+    token = _shared_session.set(db_session)
+    try:
+        yield
+    finally:
+        _shared_session.reset(token)
+        db_session.close()
 
 def _ensure_context(chat_id: int) -> ChatContext:
-    """Creates or returns the chat context (message history)"""
+    """Returns the chat context (system prompt followed by message history)"""
     # Database-based method
     if USE_DATABASE and db_initialized and Session is not None and all([
             get_or_create_chat, get_system_prompt, set_system_prompt, 
             add_message, get_chat_history]):
         try:
-            db_session = Session()
+            # The previous exchange may still be queued; the history read below must include it
+            _flush_chat_exchanges(chat_id)
+            db_session = _open_session()
             
             # Get or create chat
             get_or_create_chat(db_session, chat_id)
@@ -167,113 +424,233 @@ def _ensure_context(chat_id: int) -> ChatContext:
                     logging.info(f"Set default system prompt for chat {chat_id}")
                 
                 # Save the prompt in memory
-                PROMPTS[chat_id] = system_prompt
+                _set_prompt(chat_id, system_prompt)
             
             # Get the chat history
-            from yandexgpt_bot.config import MAX_HISTORY_TURNS
             history = get_chat_history(db_session, chat_id, limit=1 + 2 * MAX_HISTORY_TURNS)
             
-            db_session.close()
+            _close_session(db_session)
             return history
         except Exception as e:
             logging.error(f"Error ensuring context from database: {e}")
             # Fall back to in-memory method
     
     # In-memory method
-    if chat_id not in HISTORIES:
-        prompt = PROMPTS.get(chat_id, DEFAULT_SYSTEM_PROMPT)
-        HISTORIES[chat_id] = [{"role": "system", "text": prompt}]
-    return HISTORIES[chat_id]
-
-def _truncate_history(history: ChatContext) -> None:
-    from yandexgpt_bot.config import MAX_HISTORY_TURNS
-    extra = len(history) - (1 + 2 * MAX_HISTORY_TURNS)
-    if extra > 0:
-        del history[1:1 + extra]
-
-def _is_unlimited(chat_id: int) -> bool:
-    # Database-based method
-    if USE_DATABASE and db_initialized and Session is not None and get_or_create_chat is not None:
-        try:
-            db_session = Session()
-            chat = get_or_create_chat(db_session, chat_id)
-            is_unlimited = chat.is_unlimited
-            db_session.close()
-            return is_unlimited
-        except Exception as e:
-            logging.error(f"Error checking unlimited status from database: {e}")
-            # Fall back to in-memory method
-    
-    # In-memory method
-    return chat_id in UNLIMITED_IDS
+    history = HISTORIES.get(chat_id)
+    if history is None:
+        history = _new_history()
+        _remember(HISTORIES, chat_id, history)
+    else:
+        HISTORIES.move_to_end(chat_id)
+    prompt = PROMPTS.get(chat_id, DEFAULT_SYSTEM_PROMPT)
+    return [{"role": "system", "text": prompt}, *(m._asdict() for m in history)]
 
 def _check_and_increment_usage(chat_id: int) -> bool:
+    # Unlimited chats are cached in memory (and kept in sync with the database),
+    # so they never cost a query
+    if chat_id in UNLIMITED_IDS:
+        return True
+    
     # Database-based method
     if USE_DATABASE and db_initialized and Session is not None and check_and_increment_usage is not None:
         try:
-            db_session = Session()
-            from yandexgpt_bot.config import DAILY_LIMIT
+            db_session = _open_session()
             result = check_and_increment_usage(db_session, chat_id, DAILY_LIMIT)
-            db_session.close()
+            _close_session(db_session)
             return result
         except Exception as e:
             logging.error(f"Error checking usage from database: {e}")
             # Fall back to in-memory method
     
     # In-memory method
-    if _is_unlimited(chat_id):
-        return True
-    from yandexgpt_bot.config import DAILY_LIMIT
-    today = _dt.date.today()
-    last_date, count = DAILY_USAGE.get(chat_id, (today, 0))
-    if last_date != today:
-        count = 0
+    today = _TODAY
+    packed = DAILY_USAGE.get(chat_id, 0)
+    count = packed & _COUNT_MASK if packed >> 32 == today else 0
     if count >= DAILY_LIMIT:
         return False
-    DAILY_USAGE[chat_id] = (today, count + 1)
+    DAILY_USAGE[chat_id] = (today << 32) | (count + 1)
+    mark_state_dirty("daily_usage")
     return True
 
 def _check_and_increment_image_usage(chat_id: int) -> bool:
+    # Unlimited chats are cached in memory (and kept in sync with the database),
+    # so they never cost a query
+    if chat_id in UNLIMITED_IDS:
+        return True
+    
     # Database-based method
     if USE_DATABASE and db_initialized and Session is not None and check_and_increment_image_usage is not None:
         try:
-            db_session = Session()
-            from yandexgpt_bot.config import IMAGE_GENERATION_LIMIT
+            db_session = _open_session()
             result = check_and_increment_image_usage(db_session, chat_id, IMAGE_GENERATION_LIMIT)
-            db_session.close()
+            _close_session(db_session)
             return result
         except Exception as e:
             logging.error(f"Error checking image usage from database: {e}")
             # Fall back to in-memory method
     
     # In-memory method
-    if _is_unlimited(chat_id):
-        return True
-    from yandexgpt_bot.config import IMAGE_GENERATION_LIMIT
-    today = _dt.date.today()
-    last_date, count = DAILY_IMAGE_USAGE.get(chat_id, (today, 0))
-    if last_date != today:
-        count = 0
+    today = _TODAY
+    packed = DAILY_IMAGE_USAGE.get(chat_id, 0)
+    count = packed & _COUNT_MASK if packed >> 32 == today else 0
     if count >= IMAGE_GENERATION_LIMIT:
         return False
-    DAILY_IMAGE_USAGE[chat_id] = (today, count + 1)
+    DAILY_IMAGE_USAGE[chat_id] = (today << 32) | (count + 1)
+    mark_state_dirty("image_usage")
     return True
 
-# Add functions to save messages to database
-def _add_message_to_history(chat_id: int, role: str, text: str) -> None:
-    """Add a message to the chat history (both in-memory and database)"""
-    # Add to in-memory history first
+# Exchanges are written to the database by one background writer, so /ask
+# replies without waiting for the INSERT and COMMIT. Anything that reads or
+# deletes a chat's database history first calls _flush_chat_exchanges, so it
+# always sees the exchanges recorded before it
+_EXCHANGE_BATCH_MAX = 100
+# Seconds the writer waits before retrying after the database could not be reached
+_EXCHANGE_RETRY_DELAY = 5.0
+# Guards _pending_exchanges and _writing_chats; held only for dict updates
+_pending_lock = threading.Lock()
+# Held for the whole take-and-write, so a flush waits for a write in flight
+_exchange_write_lock = threading.Lock()
+# chat_id -> [(question, answer, user_info)], oldest chat first
+_pending_exchanges: "OrderedDict[int, List[tuple]]" = OrderedDict()
+_writing_chats: Set[int] = set()
+_exchanges_queued = asyncio.Event()
+
+def _record_exchange(chat_id: int, question: str, answer: str, user=None) -> None:
+    """Add a question and its answer to the chat history; the database write is queued"""
     if chat_id in HISTORIES:
-        HISTORIES[chat_id].append({"role": role, "text": text})
+        HISTORIES[chat_id].extend((Turn("user", question), Turn("assistant", answer)))
     
-    # Add to database if enabled
-    if USE_DATABASE and db_initialized and Session is not None and add_message is not None:
+    if USE_DATABASE and db_initialized and Session is not None and bulk_add_histories is not None:
+        user_info = None
+        if user is not None:
+            user_info = (user.id, getattr(user, 'username', None), getattr(user, 'first_name', None))
+        with _pending_lock:
+            _pending_exchanges.setdefault(chat_id, []).append((question, answer, user_info))
+        _exchanges_queued.set()
+
+def _store_exchanges(db_session, exchanges: Dict[int, List[tuple]]) -> None:
+    """Stage exchanges grouped by chat: one sequence query, one bulk insert and the usage records"""
+    sequences = next_sequences(db_session, list(exchanges))
+    histories = []
+    for chat_id, items in exchanges.items():
+        turns = []
+        for question, answer, _ in items:
+            turns += (("user", question), ("assistant", answer))
+        histories.append((chat_id, sequences[chat_id], turns))
+    bulk_add_histories(db_session, histories, commit=False)
+    for chat_id, items in exchanges.items():
+        for _, _, user_info in items:
+            if user_info is not None:
+                user_id, username, first_name = user_info
+                add_usage_record(
+                    db_session, chat_id, user_id=user_id,
+                    user_username=username, user_first_name=first_name,
+                    commit=False,
+                )
+
+def _write_exchanges(exchanges: Dict[int, List[tuple]]) -> None:
+    """Store exchanges in one transaction, falling back to one transaction per exchange on failure.
+
+    Written and rejected exchanges are removed from the dict; if the database
+    cannot be reached the error is raised and the dict holds what is left"""
+    # A session of its own: a rollback here must not touch a caller's shared session
+    db_session = Session()
+    try:
         try:
-            db_session = Session()
-            add_message(db_session, chat_id, role, text)
-            db_session.close()
+            _store_exchanges(db_session, exchanges)
+            db_session.commit()
+            exchanges.clear()
+            return
         except Exception as e:
-            logging.error(f"Error adding message to database: {e}")
+            db_session.rollback()
+            if is_disconnect_error(e):
+                raise
+            logging.warning(f"Batched write of exchanges failed, retrying one by one: {e}")
+        # One bad exchange must not take the rest of the batch down with it
+        for chat_id in list(exchanges):
+            items = exchanges[chat_id]
+            while items:
+                try:
+                    _store_exchanges(db_session, {chat_id: items[:1]})
+                    db_session.commit()
+                except Exception as e:
+                    db_session.rollback()
+                    if is_disconnect_error(e):
+                        raise
+                    logging.error(f"Error saving exchange for chat {chat_id} to database: {e}")
+                del items[0]
+            del exchanges[chat_id]
+    finally:
+        db_session.close()
+
+def _take_pending_exchanges(chat_id=None) -> Dict[int, List[tuple]]:
+    """Removes the given chat's exchanges, or a batch of the oldest, from the queue"""
+    taken: Dict[int, List[tuple]] = {}
+    with _pending_lock:
+        if chat_id is not None:
+            if chat_id in _pending_exchanges:
+                taken[chat_id] = _pending_exchanges.pop(chat_id)
+        else:
+            count = 0
+            while _pending_exchanges and count < _EXCHANGE_BATCH_MAX:
+                pending_chat, items = _pending_exchanges.popitem(last=False)
+                taken[pending_chat] = items
+                count += len(items)
+        _writing_chats.update(taken)
+    return taken
+
+def _requeue_exchanges(exchanges: Dict[int, List[tuple]]) -> None:
+    """Puts unwritten exchanges back at the head of the queue, ahead of any recorded since"""
+    with _pending_lock:
+        for chat_id, items in reversed(list(exchanges.items())):
+            _pending_exchanges[chat_id] = items + _pending_exchanges.get(chat_id, [])
+            _pending_exchanges.move_to_end(chat_id, last=False)
+
+def _write_pending_exchanges(chat_id=None) -> None:
+    """Writes queued exchanges of one chat, or a batch of the oldest ones"""
+    with _exchange_write_lock:
+        exchanges = _take_pending_exchanges(chat_id)
+        chats = list(exchanges)
+        try:
+            if exchanges:
+                _write_exchanges(exchanges)
+        except Exception:
+            # Nothing is lost: the unwritten exchanges wait for the next attempt
+            _requeue_exchanges(exchanges)
+            raise
+        finally:
+            with _pending_lock:
+                _writing_chats.difference_update(chats)
+
+def _flush_chat_exchanges(chat_id: int) -> None:
+    """Makes sure every exchange recorded for the chat is in the database"""
+    with _pending_lock:
+        if chat_id not in _pending_exchanges and chat_id not in _writing_chats:
+            return
+    # Waits for a batch in flight that holds this chat, then writes what is left
+    _write_pending_exchanges(chat_id)
+
+async def _write_exchanges_continuously() -> None:
+    while True:
+        await _exchanges_queued.wait()
+        _exchanges_queued.clear()
+        # Whatever queued up during the previous write goes out in the next batch
+        while _pending_exchanges:
+            try:
+                await asyncio.to_thread(_write_pending_exchanges)
+            except Exception as e:
+                logging.error(f"Error writing queued exchanges, retrying in {_EXCHANGE_RETRY_DELAY}s: {e}")
+                await asyncio.sleep(_EXCHANGE_RETRY_DELAY)
+
+async def _drain_pending_exchanges() -> None:
+    """Write every exchange still waiting in the queue"""
+    while _pending_exchanges:
+        try:
+            await asyncio.to_thread(_write_pending_exchanges)
+        except Exception as e:
+            pending = sum(len(items) for items in _pending_exchanges.values())
+            logging.error(f"Could not write {pending} queued exchanges before shutdown: {e}")
+            return
 
 def _reset_chat_history(chat_id: int) -> None:
     """Reset chat history (both in-memory and database)"""
@@ -283,9 +660,11 @@ def _reset_chat_history(chat_id: int) -> None:
     # Reset database history if enabled
     if USE_DATABASE and db_initialized and Session is not None and reset_chat_history is not None:
         try:
-            db_session = Session()
+            # Exchanges recorded before the reset must be deleted by it, not land after it
+            _flush_chat_exchanges(chat_id)
+            db_session = _open_session()
             reset_chat_history(db_session, chat_id)
-            db_session.close()
+            _close_session(db_session)
         except Exception as e:
             logging.error(f"Error resetting chat history in database: {e}")
 
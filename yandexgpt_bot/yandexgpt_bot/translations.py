@@ -3,7 +3,6 @@ Translation module for the YandexGPT bot interface.
 Provides multilingual text for bot messages.
 """
 from .config import LANGUAGE
-import yaml
 
 # Translation dictionary
 TRANSLATIONS = {
@@ -261,6 +260,11 @@ TRANSLATIONS = {
 }
 
 
+# Flattened lookup tables built once at import: one hash probe per lookup
+_FLAT = {(key, lang): text for key, langs in TRANSLATIONS.items() for lang, text in langs.items()}
+_FLAT_EN = {key: langs["english"] for key, langs in TRANSLATIONS.items() if "english" in langs}
+
+
 def get_text(key, lang=None, **format_args):
     """
     Retrieve translation text by key.
@@ -276,16 +280,10 @@ def get_text(key, lang=None, **format_args):
     if lang is None:
         lang = LANGUAGE
 
-    # Fallback to English if unsupported language
-    if lang not in ["english", "russian"]:
-        lang = "english"
-
-    # Attempt to get translation
-    translation = TRANSLATIONS.get(key, {}).get(lang)
-
-    # Fallback to English or key
+    # Attempt to get translation; unsupported languages fall back to English or key
+    translation = _FLAT.get((key, lang))
     if translation is None:
-        translation = TRANSLATIONS.get(key, {}).get("english") or key
+        translation = _FLAT_EN.get(key) or key
 
     return translation.format(**format_args) if format_args else translation
 
@@ -1,26 +1,29 @@
 import asyncio
-from .config import YC_FOLDER_ID, YC_API_KEY, YANDEXGPT_MODEL, GPT_TEMPERATURE
+from concurrent.futures import ThreadPoolExecutor
+from .config import YC_FOLDER_ID, YC_API_KEY, YANDEXGPT_MODEL, GPT_TEMPERATURE, SDK_MAX_WORKERS
 from yandex_cloud_ml_sdk import YCloudML
 
 SDK = YCloudML(folder_id=YC_FOLDER_ID, auth=YC_API_KEY)
 
+# Model settings are constant, so the configured models are built once and reused
+COMPLETIONS_MODEL = SDK.models.completions(YANDEXGPT_MODEL).configure(temperature=GPT_TEMPERATURE)
+IMAGE_MODEL = SDK.models.image_generation("yandex-art").configure(width_ratio=1, height_ratio=1)
+
+# Dedicated pool for blocking SDK calls so they neither starve nor get starved by
+# other work on the loop's default executor
+SDK_POOL = ThreadPoolExecutor(max_workers=SDK_MAX_WORKERS, thread_name_prefix="ycloud")
+
 async def generate_reply(history):
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     def _call():
-        result = (
-            SDK.models.completions(YANDEXGPT_MODEL)
-            .configure(temperature=GPT_TEMPERATURE)
-            .run(history)
-        )
+        result = COMPLETIONS_MODEL.run(history)
         return result[0].text if result else "(empty response)"
-    return await loop.run_in_executor(None, _call)
+    return await loop.run_in_executor(SDK_POOL, _call)
 
 async def generate_image(description: str) -> bytes:
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     def _generate():
-        model = SDK.models.image_generation("yandex-art")
-        model = model.configure(width_ratio=1, height_ratio=1)
-        operation = model.run_deferred(description)
+        operation = IMAGE_MODEL.run_deferred(description)
         result = operation.wait()
         return result.image_bytes
-    return await loop.run_in_executor(None, _generate) 
\ No newline at end of file
+    return await loop.run_in_executor(SDK_POOL, _generate)